@@ -5,13 +5,18 @@ import re
 import sys
 import errno
 import tempfile
+import threading
 from subprocess import Popen, PIPE
 import shutil
 import time
 from time import ctime
 import argparse
+import hashlib
+import json
 import logging
-from collections import defaultdict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, deque
 from operator import itemgetter
 
 from lxml import etree
@@ -20,6 +25,7 @@ from mako import exceptions
 
 BINDIR = os.path.dirname(os.path.realpath(sys.argv[0]))
 sys.path.append(os.path.join(BINDIR, "..", "lib", "python"))
+import tpldocutils
 
 log = logging.getLogger("annotations2html")
 
@@ -28,6 +34,26 @@ template_re = re.compile(r"^\s*(?:(?:object|structure|declaration|unique)\s+)*"
 
 panc_annotations = "panc-annotations"
 
+# number of templates passed to a single panc-annotations run
+CHUNK_SIZE = 1000
+# number of pages handed to a render worker at once
+RENDER_CHUNK_SIZE = 16
+# seconds between looks for new annotation files while panc runs
+WATCH_INTERVAL = 0.2
+
+# the build manifest of incremental builds
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# the template declarations found by the pre-scan
+DECLARATIONS_FILE = "declarations.json"
+DECLARATIONS_VERSION = 1
+# templates are scanned for their declaration in blocks of this size,
+# the declaration is almost always in the first block
+SCAN_BLOCK_SIZE = 8192
+# number of templates handed to a scan thread at once
+SCAN_CHUNK_SIZE = 64
+
 # TEMPLATES_BYNAME is an indexed keyed by template name
 # (the template name may be ambiguous due to LOADPATH)
 TEMPLATES_BYNAME = defaultdict(list)
@@ -45,38 +71,73 @@ def is_template(name):
     return False
 
 
-def parse_panc_errors(text):
-    ret = defaultdict(list)
-    filename = None
-    errortxt = None
-    lines = None
-    output = list()
+class PancErrorParser(object):
+    """
+    Parse the output of panc line by line, collecting the errors and
+    the output lines following them per template.
+    """
 
-    relativeize = re.compile(os.getcwd() + "/(.*)\\.((pan)|(tpl))")
     error = re.compile(r'(?P<err>[\w\s]+) \[(?P<file>.*):(?P<lines>[0-9.-]+)\]$')
-    for line in text.split("\n"):
-        m = error.match(line)
+
+    def __init__(self):
+        self.errors = defaultdict(list)
+        self.filename = None
+        self.errortxt = None
+        self.lines = None
+        self.output = list()
+
+    def feed(self, line):
+        """Parse a line of output, without its newline"""
+        m = self.error.match(line)
         if m:
             # flush out old error
-            if filename is not None:
-                ret[filename].append([errortxt, lines, output])
+            self.flush()
 
             parts = m.groupdict()
-            filename = parts["file"]
             # filename emmitted by panc is a full absolute pathname.
             # we want to work out a normalized name
-            filename = os.path.relpath(filename, os.getcwd())
-            errortxt = parts["err"]
-            lines = parts["lines"]
-            output = list()
+            self.filename = os.path.relpath(parts["file"], os.getcwd())
+            self.errortxt = parts["err"]
+            self.lines = parts["lines"]
+            self.output = list()
         else:
-            output.append(line)
+            self.output.append(line)
 
-    # flush out old error
-    if filename is not None:
-        ret[filename].append([errortxt, lines, output])
+    def flush(self):
+        if self.filename is not None:
+            self.errors[self.filename].append([self.errortxt, self.lines,
+                                               self.output])
 
-    return ret
+    def close(self):
+        """Return the errors per template"""
+        # flush out old error
+        self.flush()
+        self.filename = None
+        return self.errors
+
+
+def parse_panc_errors(text):
+    parser = PancErrorParser()
+    for line in text.split("\n"):
+        parser.feed(line)
+    return parser.close()
+
+
+def read_panc_output(fd, parser=None):
+    """
+    Read the output of panc from fd as it comes, parse it with parser
+    (if set) like parse_panc_errors parses the whole text.
+    """
+    last = "\n"
+    for line in iter(fd.readline, ""):
+        last = line
+        if line.endswith("\n"):
+            line = line[:-1]
+        log.debug("panc: %s", line)
+        if parser is not None:
+            parser.feed(line)
+    if parser is not None and last.endswith("\n"):
+        parser.feed("")
 
 
 def render_one(outfile, transform, args):
@@ -89,14 +150,84 @@ def render_one(outfile, transform, args):
         fd.write(result)
 
 
+def render_page(outfile, section, context, navigation):
+    """
+    Render the page of a template with the transform of its section.
+
+    The context holds the plain data of the template, including the
+    summary of its annotations; the shared indexes are added here.
+    """
+    if section not in transformers:
+        transformers[section] = get_transform(section + "_template")
+
+    args = dict(context)
+    if args.pop('two_pass', False):
+        # second pass: the page refers to the template source on disk
+        with open(context['source'], "r") as fd:
+            args['source'] = fix_unicode(fd.read())
+    args.update({'navigation': navigation,
+                 'index': TEMPLATES_BYNAME})
+    render_one(outfile, transformers[section], args)
+
+
+def init_render_worker(navigation):
+    """Keep the navigation index in a render worker"""
+    global render_navigation
+    render_navigation = navigation
+
+
+def render_worker(page):
+    """Render an (outfile, section, context) page in a render worker"""
+    render_page(page[0], page[1], page[2], render_navigation)
+
+
+def render_pages(pages, navigation, jobs):
+    """
+    Render the deferred pages with jobs processes.
+
+    The workers are forked once the indexes are complete, so they
+    inherit TEMPLATES_BYNAME; every page is written by its worker.
+    """
+    if jobs <= 1 or len(pages) <= 1:
+        for (outfile, section, context) in pages:
+            render_page(outfile, section, context, navigation)
+        return
+
+    pool = Pool(jobs, init_render_worker, (navigation,))
+    try:
+        for _ in pool.imap_unordered(render_worker, pages, RENDER_CHUNK_SIZE):
+            pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def annotate(templates, index, state, base_path, outdir, render_at_end):
     if not templates:
         return
 
+    tmpdir, errors, summaries, returncode = run_panc(templates, base_path)
+    return process_annotations(tmpdir, errors, index, state, base_path, outdir,
+                               render_at_end)
+
+
+def run_panc(templates, base_path, tmpdir_base=None, watch=False):
+    """
+    Run panc-annotations on templates relative to base_path.
+
+    Returns the temporary directory holding the annotation xml, the
+    panc errors per template, the summaries of the annotation files and
+    the return code of panc. The caller has to remove the directory.
+    The temporary directory is made in tmpdir_base, if it is set.
+    The output of panc is parsed as it comes. With watch, the
+    annotation files are summarized as soon as panc has written them,
+    while it is still running; otherwise there are no summaries.
+    """
     # Get a temporary directory. panc annotations
     # will be dumped into directory names corresponding
     # to the template namespace, so we need a small tree
-    tmpdir = tempfile.mkdtemp()
+    tmpdir = tempfile.mkdtemp(dir=tmpdir_base)
     try:
         os.makedirs(os.path.join(tmpdir, base_path))
     except OSError as exc:
@@ -105,8 +236,8 @@ def annotate(templates, index, state, base_path, outdir, render_at_end):
         else:
             raise
 
-    deferred = []
-
+    p = None
+    readers = []
     try:
         # Run "panc" to get the annotation data
         args = [panc_annotations, "--output-dir", tmpdir]
@@ -117,25 +248,256 @@ def annotate(templates, index, state, base_path, outdir, render_at_end):
         sys.stdout.flush()
 
         p = Popen(args, stderr=PIPE, stdout=PIPE)
-        out, err = p.communicate()
-        log.info("command returned %d", p.returncode)
-        log.debug("command stdout:\n%s", out)
-        log.debug("command stderr:\n%s", err)
+        parser = PancErrorParser()
+        for fd, fd_parser in ((p.stdout, parser), (p.stderr, None)):
+            reader = threading.Thread(target=read_panc_output,
+                                      args=(fd, fd_parser))
+            reader.start()
+            readers.append(reader)
+
+        summaries = dict()
+        while watch and p.poll() is None:
+            summarize_new_annotations(tmpdir, summaries)
+            time.sleep(WATCH_INTERVAL)
+
+        for reader in readers:
+            reader.join()
+        p.wait()
+        if p.returncode != 0:
+            log.error("%s returned %d", panc_annotations, p.returncode)
+        else:
+            log.info("command returned %d", p.returncode)
+    except:
+        # Make sure panc no longer writes in tmpdir before removing it
+        if p is not None:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+        for reader in readers:
+            reader.join()
+        shutil.rmtree(tmpdir)
+        raise
+
+    return tmpdir, parser.close(), summaries, p.returncode
+
+
+def run_panc_jobs(pool, jobs, njobs):
+    """
+    Run panc in pool for the (templates, base_path[, tmpdir_base[, watch]])
+    jobs, yield every job with its result in job order.
+
+    At most njobs jobs are submitted ahead of the one that is consumed,
+    so the annotation xml of only a few jobs is kept at a time; with
+    one job, panc and the consumer take turns as in a serial run.
+    """
+    pending = deque()
+    for job in jobs:
+        if len(pending) >= max(njobs, 1):
+            done = pending.popleft()
+            yield done[0], done[1].get()
+        pending.append((job, pool.apply_async(run_panc, job)))
+    while pending:
+        done = pending.popleft()
+        yield done[0], done[1].get()
+
+
+def summarize_new_annotations(tmpdir, summaries):
+    """
+    Summarize the annotation files panc has finished in tmpdir so far,
+    the summaries are kept per file with its size and mtime.
+    """
+    for root, dirs, files in os.walk(tmpdir):
+        for file in files:
+            path = os.path.join(root, file)
+            if not file.endswith(".xml") or path in summaries:
+                continue
+            try:
+                st = os.stat(path)
+                with open(path, "rb") as fd:
+                    summary = summarize_annotations(etree.parse(fd))
+            except (IOError, OSError, etree.XMLSyntaxError):
+                # panc is still writing it
+                continue
+            summaries[path] = ((st.st_size, st.st_mtime), summary)
+
+
+def load_summary(path, summaries=None):
+    """
+    Return the summary of an annotation file, from summaries if the
+    file did not change since it was summarized.
+    """
+    if summaries and path in summaries:
+        stamp, summary = summaries.pop(path)
+        st = os.stat(path)
+        if stamp == (st.st_size, st.st_mtime):
+            return summary
+    with open(path, "rb") as fd:
+        return summarize_annotations(etree.parse(fd))
+
+
+def sort_annotation_files(files):
+    """Sort the annotation files of a directory in the order they are processed"""
+    important = "documentation.annotation.xml"
+    files.sort()
+    try:
+        # Try and move the important file to the front,
+        # but it may not exist. If we can't never mind -
+        # just process the sorted list.
+        files.remove(important)
+        files.insert(0, important)
+    except ValueError:
+        pass
+
+
+def summarize_annotations(xml):
+    """
+    Return the summary record of the annotations of a template, in a
+    single pass over the xml.
+
+    It is plain data with all the indexes and the pages use (texts are
+    None if the element is missing, like findtext), so the xml tree can
+    be dropped right away.
+    """
+    summary = {'section': None, 'title': None, 'desc': None,
+               'synopsis': None, 'see-also': None,
+               'source-range': None, 'functions': [], 'variables': []}
+    root = xml.getroot()
+    if root is None:
+        return summary
+    summary['source-range'] = root.get('source-range')
+    prefix = "{%s}" % ns
+    for element in root:
+        if not isinstance(element.tag, basestring) or \
+                not element.tag.startswith(prefix):
+            continue
+        tag = element.tag[len(prefix):]
+        if tag in ('function', 'variable'):
+            summary[tag + 's'].append((element.attrib['name'],
+                                       element.get('desc')))
+        elif tag in summary and summary[tag] is None:
+            summary[tag] = element.text or ''
+    for key in ('functions', 'variables'):
+        summary[key].sort(key=lambda x: x[0].lower())
+    return summary
+
+
+def annotate_file(root, relpath, file, errors, index, state, base_path,
+                  outdir, two_pass=False, summaries=None):
+    """
+    Index the annotation xml file in root, relpath is its path in the template namespace.
+    Summaries made while panc was running are used if they are up to date.
+
+    Returns the (outfile, section, context) of the page of the template.
+    """
+    log.debug("parsing %s/%s", relpath, file)
+    # Create a filename to dump the HTML output
+    htmlname = os.path.join(relpath, file)
+    htmlname = re.sub(r'\.xml$', '.html', htmlname)
+    htmlname = re.sub(r'/', '.', htmlname)
+    outfile = os.path.join(outdir, htmlname)
+
+    summary = load_summary(os.path.join(root, file), summaries)
+
+    # Work out what section we're in - we allow
+    # the input templates to modify this (so that you
+    # can have a documentation.tpl in a directory
+    # that sets the section name for all subsequent
+    # templates)
+    section = summary['section']
+    if section is not None:
+        log.info("found section %s for path %s", section, relpath)
+        state[relpath]['section'] = section
+    section = state[relpath]['section']
+
+    # Generate some text representing the template itself
+    source = file[0:-len(".annotation.xml")]
+    tplname = os.path.join(relpath, source)
+
+    myerrors = None
+    errname = os.path.join(relpath, file)
+    errname = errname[0:-len(".annotation.xml")]
+    if errname in errors:
+        myerrors = errors[errname]
+
+    sourcefile = tplname
+    mtime = ctime(os.stat(tplname).st_mtime)
+    sourcefd = open(tplname, "r")
+    tplsource = fix_unicode(sourcefd.read())
+
+    # The source-range will provide the pointer to the template
+    if summary['source-range'] is not None:
+        srange = summary['source-range']
+        lines = tplsource.split("\n")
+        (start, end) = srange.split('-', 2)
+        (sline, schar) = start.split('.', 2)
+        (eline, echar) = end.split('.', 2)
+        declaration = "\n".join(lines[int(sline) - 1:int(eline)])
+        m = re.search(r'template ([^;]*)', declaration)
+        if m:
+            # We modify the template name to allow for loadpath
+            tplname = m.group(1)
 
-        errors = parse_panc_errors(out)
+    if base_path != "":
+        entry_title = "%s (%s)" % (tplname, base_path)
+    else:
+        entry_title = "%s (top level)" % tplname
+
+    TEMPLATES_BYNAME[tplname].append((htmlname, entry_title))
+    if len(TEMPLATES_BYNAME[tplname]) > 1:
+        TEMPLATES_BYNAME[tplname].sort()
+
+    title = summary['title']
+    if title is None:
+        title = tplname
+
+    # Indexing
+    for name, desc in summary['functions']:
+        index_add(index, "functions", "%s()" % name, htmlname, entry_title)
+    for name, desc in summary['variables']:
+        index_add(index, "global variables", name, htmlname, entry_title)
+
+    index_add(index, section, title, htmlname, entry_title)
+
+    # This is incredibly memory hungry, but we're going to
+    # just stash things in memory and then render at the end,
+    # allowing files to contain cross-referencing indexes.
+    # if memory usage gets too bad, then we can drop the
+    # cross-referencing within specific files and render as we
+    # go...
+    # Only plain data is kept (the summary of the annotations), so
+    # the pages can be rendered by other processes.
+    context = {'title': title,
+               'tplname': tplname,
+               'htmlname': htmlname,
+               'source': tplsource,
+               'errors': myerrors,
+               'section': section,
+               'mtime': mtime,
+               'summary': summary,
+               'state': state[relpath]}
+    if two_pass:
+        context['source'] = sourcefile
+        context['two_pass'] = True
+    return (outfile, section, context)
+
+
+def process_annotations(tmpdir, errors, index, state, base_path, outdir,
+                        render_at_end, two_pass=False, summaries=None):
+    """
+    Index and render the annotations panc wrote in tmpdir, errors are the
+    panc errors per template and summaries the annotation files
+    summarized while panc was running.
+
+    The tmpdir is removed afterwards. With two_pass, only the indexes
+    are built and the deferred pages refer to the template source on
+    disk, to be read again when rendering.
+    """
+    deferred = []
 
-        important = "documentation.annotation.xml"
+    try:
         # And now parse all the annotations that we received
         for root, dirs, files in os.walk(tmpdir, topdown=True):
-            files.sort()
-            try:
-                # Try and move the important file to the front,
-                # but it may not exist. If we can't never mind -
-                # just process the sorted list.
-                files.remove(important)
-                files.insert(0, important)
-            except:
-                pass
+            sort_annotation_files(files)
 
             relpath = os.path.relpath(root, tmpdir)
             if relpath not in state:
@@ -145,106 +507,13 @@ def annotate(templates, index, state, base_path, outdir, render_at_end):
                 if not file.endswith(".xml"):
                     continue
 
-                log.debug("parsing %s/%s", relpath, file)
-                # Create a filename to dump the HTML output
-                htmlname = os.path.join(relpath, file)
-                htmlname = re.sub(r'\.xml$', '.html', htmlname)
-                htmlname = re.sub(r'/', '.', htmlname)
-                outfile = os.path.join(outdir, htmlname)
-
-                xml = etree.parse(os.path.join(root, file))
-
-                # Work out what section we're in - we allow
-                # the input templates to modify this (so that you
-                # can have a documentation.tpl in a directory
-                # that sets the section name for all subsequent
-                # templates)
-                section = xml.findtext("{%s}section" % ns)
-                if section is not None:
-                    log.info("found section %s for path %s", section, relpath)
-                    state[relpath]['section'] = section
-                section = state[relpath]['section']
-
-                # Generate some text representing the template itself
-                source = file[0:-len(".annotation.xml")]
-                tplname = os.path.join(relpath, source)
-
-                myerrors = None
-                errname = os.path.join(relpath, file)
-                errname = errname[0:-len(".annotation.xml")]
-                if errname in errors:
-                    myerrors = errors[errname]
-
-                mtime = ctime(os.stat(tplname).st_mtime)
-                sourcefd = open(tplname, "r")
-                tplsource = fix_unicode(sourcefd.read())
-
-                tnode = xml.getroot()
-                # The source-range will provide the pointer to the template
-                if tnode is not None and 'source-range' in tnode.attrib:
-                    srange = tnode.attrib['source-range']
-                    lines = tplsource.split("\n")
-                    (start, end) = srange.split('-', 2)
-                    (sline, schar) = start.split('.', 2)
-                    (eline, echar) = end.split('.', 2)
-                    declaration = "\n".join(lines[int(sline) - 1:int(eline)])
-                    m = re.search(r'template ([^;]*)', declaration)
-                    if m:
-                        # We modify the template name to allow for loadpath
-                        tplname = m.group(1)
-
-                if base_path != "":
-                    entry_title = "%s (%s)" % (tplname, base_path)
-                else:
-                    entry_title = "%s (top level)" % tplname
-
-                TEMPLATES_BYNAME[tplname].append((htmlname, entry_title))
-                if len(TEMPLATES_BYNAME[tplname]) > 1:
-                    TEMPLATES_BYNAME[tplname].sort()
-
-                title = xml.findtext("{%s}title" % ns)
-                if title is None:
-                    title = tplname
-
-                content = None
-                # Indexing
-                for fn in xml.findall("{%s}function" % ns):
-                    index_add(index, "functions", "%s()" % fn.attrib['name'],
-                              htmlname, entry_title)
-                    content = True
-                for var in xml.findall("{%s}variable" % ns):
-                    index_add(index, "global variables", var.attrib['name'],
-                              htmlname, entry_title)
-                    content = True
-
-                index_add(index, section, title, htmlname, entry_title)
-
-                if section not in transformers:
-                    transformers[section] = get_transform(section + "_template")
-                transform = transformers[section]
-
-                # This is incredibly memory hungry, but we're going to
-                # just stash things in memory and then render at the end,
-                # allowing files to contain cross-referencing indexes.
-                # if memory usage gets too bad, then we can drop the
-                # cross-referencing within specific files and render as we
-                # go...
-                context = {'title': title,
-                           'tplname': tplname,
-                            'htmlname': htmlname,
-                            'navigation': index,
-                            'source': tplsource,
-                            'errors': myerrors,
-                            'section': section,
-                            'mtime': mtime,
-                            'xml': xml,
-                            'ns': ns,
-                            'state': state[relpath],
-                            'index': TEMPLATES_BYNAME}
+                outfile, section, context = annotate_file(
+                    root, relpath, file, errors, index, state, base_path,
+                    outdir, two_pass, summaries)
                 if render_at_end:
-                    deferred.append((outfile, transform, context))
+                    deferred.append((outfile, section, context))
                 else:
-                    render_one(outfile, transform, context)
+                    render_page(outfile, section, context, index)
 
     finally:
         shutil.rmtree(tmpdir)
@@ -252,6 +521,299 @@ def annotate(templates, index, state, base_path, outdir, render_at_end):
     return deferred
 
 
+def file_digest(filename):
+    """Return the sha1 hex digest of the content of a file"""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as fd:
+        for block in iter(lambda: fd.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def data_digest(data):
+    """Return the sha1 hex digest of json serializable data"""
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def get_renderer_digest():
+    """
+    Return a digest of this script, the mako templates and the python
+    helpers: when any of these change, all pages have to be rendered again.
+    """
+    digest = hashlib.sha1()
+    files = [os.path.realpath(sys.argv[0])]
+    for subdir in ["templates", "python"]:
+        libdir = os.path.join(BINDIR, "..", "lib", subdir)
+        files.extend(os.path.join(libdir, f) for f in sorted(os.listdir(libdir))
+                     if not f.endswith((".pyc", ".pyo")))
+    for f in files:
+        digest.update(file_digest(f))
+    return digest.hexdigest()
+
+
+def to_str(data):
+    """Convert the unicode strings json returns back to utf-8 encoded strings"""
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    elif isinstance(data, list):
+        return [to_str(value) for value in data]
+    elif isinstance(data, dict):
+        return dict((to_str(key), to_str(value)) for key, value in data.items())
+    return data
+
+
+def load_manifest(location):
+    """
+    Return the build manifest kept in location.
+
+    The manifest has an entry per template, with its base directory, size,
+    mtime and hash, its annotation xml (relative to the annotation store),
+    the panc errors, its html page and the digest of the last rendered
+    page; the list of all template pages and the digests of the index pages.
+    An empty manifest is returned if there is no usable one.
+    """
+    renderer = get_renderer_digest()
+    manifest = {'version': MANIFEST_VERSION,
+                'renderer': renderer,
+                'templates': {},
+                'pages': [],
+                'toplevels': {}}
+    filename = os.path.join(location, MANIFEST_FILE)
+    try:
+        with open(filename) as fd:
+            old = to_str(json.load(fd))
+    except (IOError, ValueError) as exc:
+        log.info("no usable manifest %s (%s), regenerating all pages",
+                 filename, exc)
+        return manifest
+
+    if old.get('version') != MANIFEST_VERSION:
+        log.info("manifest %s has another version, regenerating all pages",
+                 filename)
+    else:
+        manifest = old
+        if manifest['renderer'] != renderer:
+            log.info("renderer changed, rendering all pages")
+            for entry in manifest['templates'].values():
+                entry['render'] = None
+            manifest['toplevels'] = dict.fromkeys(manifest['toplevels'])
+            manifest['renderer'] = renderer
+    return manifest
+
+
+def save_manifest(location, manifest):
+    """Write the build manifest in location atomically"""
+    fd, tmpfile = tempfile.mkstemp(dir=location, suffix=".tmp")
+    with os.fdopen(fd, "w") as fdo:
+        json.dump(manifest, fdo)
+    os.rename(tmpfile, os.path.join(location, MANIFEST_FILE))
+
+
+def remove_file(filename):
+    """Remove a file, if it exists"""
+    try:
+        os.remove(filename)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def find_dirty_templates(jobs, manifest, store):
+    """
+    Compare the templates of all jobs with the manifest.
+
+    Returns the jobs to run panc for, with only the new and changed
+    templates and the ones which were not annotated yet (panc wrote
+    neither annotation xml nor errors for them). The entries of those
+    templates are reset, templates which no longer exist are dropped,
+    along with their annotation xml.
+    """
+    templates = manifest['templates']
+    seen = set()
+    dirty_jobs = []
+    for chunk, base_path in jobs:
+        dirty = []
+        for tpl in chunk:
+            path = os.path.normpath(os.path.join(base_path, tpl))
+            seen.add(path)
+            st = os.stat(path)
+            entry = templates.get(path)
+            if entry and entry['base'] == base_path and (entry['xml'] or entry['errors']):
+                if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                    continue
+                digest = file_digest(path)
+                if entry['hash'] == digest:
+                    entry['size'], entry['mtime'] = st.st_size, st.st_mtime
+                    continue
+            else:
+                digest = file_digest(path)
+
+            if entry and entry['xml']:
+                remove_file(os.path.join(store, entry['xml']))
+            templates[path] = {'base': base_path,
+                               'size': st.st_size,
+                               'mtime': st.st_mtime,
+                               'hash': digest,
+                               'xml': None,
+                               'errors': None,
+                               'page': entry and entry['page'],
+                               'render': None}
+            dirty.append(tpl)
+        if dirty:
+            dirty_jobs.append((dirty, base_path))
+
+    for path in set(templates) - seen:
+        log.info("template %s was removed", path)
+        if templates[path]['xml']:
+            remove_file(os.path.join(store, templates[path]['xml']))
+        del templates[path]
+
+    return dirty_jobs
+
+
+def store_annotations(tmpdir, errors, chunk, base_path, store, templates):
+    """
+    Move the annotation xml panc wrote in tmpdir to the annotation store
+    and keep the xml and the panc errors in the entries of the templates.
+    """
+    try:
+        for tpl in chunk:
+            path = os.path.normpath(os.path.join(base_path, tpl))
+            if path in errors:
+                templates[path]['errors'] = errors[path]
+
+        for root, dirs, files in os.walk(tmpdir):
+            for file in files:
+                xmlfile = os.path.relpath(os.path.join(root, file), tmpdir)
+                path = xmlfile[0:-len(".annotation.xml")]
+                if not file.endswith(".xml") or path not in templates:
+                    continue
+                target = os.path.join(store, xmlfile)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(os.path.join(root, file), target)
+                templates[path]['xml'] = xmlfile
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def walk_stored_annotations(store, base_path, xmlfiles):
+    """
+    Walk the stored annotation xml files of a job like process_annotations
+    walks the directory panc wrote them in.
+
+    Yields a (root, relpath, files) tuple per directory, parents first.
+    """
+    dirs = defaultdict(list)
+    for relpath in [".", base_path] + [os.path.dirname(f) for f in xmlfiles]:
+        relpath = os.path.normpath(relpath)
+        while relpath not in dirs:
+            dirs[relpath] = []
+            relpath = os.path.dirname(relpath) or "."
+    for xmlfile in xmlfiles:
+        dirs[os.path.dirname(xmlfile) or "."].append(os.path.basename(xmlfile))
+
+    for relpath in sorted(dirs, key=lambda d: [] if d == "." else d.split("/")):
+        files = dirs[relpath]
+        sort_annotation_files(files)
+        yield os.path.join(store, relpath), relpath, files
+
+
+def annotate_incremental(jobs, index, state, outdir, location, njobs):
+    """
+    Annotate the templates of all jobs incrementally.
+
+    Only new and changed templates are passed to panc, their annotation
+    xml and panc errors are kept in the annotation store in location,
+    also when panc failed on some templates of a chunk. Templates with
+    neither are annotated again by the next build. All templates are
+    indexed from the store, in the same order as a full build would.
+    Returns the manifest, the deferred pages and the number of failed
+    panc runs.
+    """
+    manifest = load_manifest(location)
+    store = os.path.join(location, "annotations")
+    templates = manifest['templates']
+
+    dirty_jobs = find_dirty_templates(jobs, manifest, store)
+    log.info("%d of %d templates to annotate",
+             sum(len(chunk) for chunk, base_path in dirty_jobs),
+             len(templates))
+
+    # All panc output directories are made in a directory of their own,
+    # so the ones of jobs that are not consumed after an error are
+    # removed as well.
+    failed = 0
+    tmpdir_base = tempfile.mkdtemp(dir=location, prefix=".panc-")
+    pool = ThreadPool(max(njobs, 1))
+    try:
+        panc_jobs = [job + (tmpdir_base,) for job in dirty_jobs]
+        for job, (tmpdir, errors, summaries, returncode) in run_panc_jobs(pool, panc_jobs, njobs):
+            chunk, base_path = job[:2]
+            if returncode != 0:
+                failed += 1
+            store_annotations(tmpdir, errors, chunk, base_path, store, templates)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir_base, ignore_errors=True)
+
+    deferred = []
+    for chunk, base_path in jobs:
+        paths = [os.path.normpath(os.path.join(base_path, tpl)) for tpl in chunk]
+        errors = dict((path, templates[path]['errors']) for path in paths
+                      if templates[path]['errors'])
+        xmlfiles = [templates[path]['xml'] for path in paths
+                    if templates[path]['xml']]
+
+        for root, relpath, files in walk_stored_annotations(store, base_path, xmlfiles):
+            if relpath not in state:
+                state[relpath] = state[os.path.dirname(relpath)].copy()
+            for file in files:
+                deferred.append(annotate_file(root, relpath, file, errors,
+                                              index, state, base_path,
+                                              outdir, True))
+
+    return manifest, deferred, failed
+
+
+def select_changed_pages(pages, index, manifest, outdir):
+    """
+    Return the pages which have to be rendered: the ones whose template,
+    annotations or cross references changed since they were last rendered.
+
+    Pages of removed templates are removed from outdir.
+    """
+    templates = manifest['templates']
+    for entry in templates.values():
+        entry['page'] = None
+    navigation = sorted(index.keys())
+    changed = []
+    for page in pages:
+        outfile, section, context = page
+        entry = templates[os.path.normpath(context['source'])]
+        data = dict((key, value) for key, value in context.items()
+                    if key not in ('source', 'two_pass'))
+        data.update({'hash': entry['hash'],
+                     'navigation': navigation,
+                     'index': TEMPLATES_BYNAME[context['tplname']]})
+        digest = data_digest(data)
+        entry['page'] = context['htmlname']
+        if entry['render'] != digest or not os.path.exists(outfile):
+            entry['render'] = digest
+            changed.append(page)
+
+    htmlnames = set(context['htmlname'] for outfile, section, context in pages)
+    for htmlname in set(manifest.get('pages', [])) - htmlnames:
+        log.info("removing page %s", htmlname)
+        remove_file(os.path.join(outdir, htmlname))
+    manifest['pages'] = sorted(htmlnames)
+
+    log.info("%d of %d pages to render", len(changed), len(pages))
+    return changed
+
+
 def fix_unicode(value):
     """ Remove unusable characters from unreliable data sources """
     if value is None:
@@ -274,9 +836,17 @@ def index_add(index, section, title, href, text):
         index[section][title].sort(key=itemgetter(0))
 
 
-def build_toplevels(out, index):
+def build_toplevels(out, index, manifest=None):
+    """
+    Build the index page of every section.
+
+    With a manifest, only the index pages whose content changed since the
+    previous build are written, the contents page is always written.
+    """
     log.info("building index files")
 
+    navigation = sorted(index.keys())
+    toplevels = dict()
     for section in index.keys():
         log.info("building %s", section)
         idxbody = []
@@ -313,12 +883,26 @@ def build_toplevels(out, index):
                    'title': s}
 
         outfile = os.path.join(out, "%s.html" % safe)
+        if manifest is not None:
+            digest = data_digest([idxbody, navigation, section, s])
+            toplevels[safe] = digest
+            if section != 'contents' and os.path.exists(outfile) and \
+               manifest['toplevels'].get(safe) == digest:
+                log.debug("%s did not change", outfile)
+                continue
+
         result = None
         result = transform.render(**context)
         log.debug("writing %s", outfile)
         with open(outfile, 'w') as fd:
             fd.write(result)
 
+    if manifest is not None:
+        for safe in set(manifest['toplevels']) - set(toplevels):
+            log.info("removing index page %s", safe)
+            remove_file(os.path.join(out, "%s.html" % safe))
+        manifest['toplevels'] = toplevels
+
 
 def get_transform(section, default='unclassified_template'):
     if section.find("/") >= 0:
@@ -337,19 +921,31 @@ transformers = dict()
 transformers["unclassified"] = get_transform("unclassified")
 
 
-def detect_template_basedir(top, filename):
-    # If top = "/path", filename = "/path/a/b/c.tpl", and it starts with
-    # "template b/c;", then we want to return (a, b/c.tpl)
-    template_name = None
-    relpath, ext = os.path.splitext(os.path.relpath(filename, top))
-    with open(filename, "r") as fd:
-        for line in fd:
-            res = template_re.match(line)
-            if not res:
-                continue
-            template_name = res.group(1)
-            break
+def scan_template_name(filename):
+    """
+    Return the template name declared in filename, None if there is none.
 
+    The file is read in blocks of SCAN_BLOCK_SIZE, up to the declaration.
+    """
+    with open(filename, "r") as fd:
+        pending = ""
+        while True:
+            block = fd.read(SCAN_BLOCK_SIZE)
+            lines = (pending + block).split("\n")
+            # the last line may continue in the next block
+            pending = lines.pop() if block else ""
+            for line in lines:
+                res = template_re.match(line)
+                if res:
+                    return res.group(1)
+            if not block:
+                return None
+
+
+def detect_template_basedir(top, filename, template_name):
+    # If top = "/path", filename = "/path/a/b/c.tpl", and it declares
+    # template_name "b/c", then we want to return (a, b/c.tpl)
+    relpath, ext = os.path.splitext(os.path.relpath(filename, top))
     if template_name and (relpath == template_name or
                           relpath.endswith("/" + template_name)):
         if relpath == template_name:
@@ -364,6 +960,86 @@ def detect_template_basedir(top, filename):
         return os.path.dirname(relpath), os.path.basename(relpath) + ext
 
 
+def load_declarations(filename, top):
+    """
+    Return the template declarations kept in filename by a previous scan
+    of top: [size, mtime, basedir, tplpath] per template path.
+    """
+    try:
+        with open(filename) as fd:
+            old = to_str(json.load(fd))
+    except (IOError, ValueError) as exc:
+        log.info("no usable declaration index %s (%s), scanning all templates",
+                 filename, exc)
+        return {}
+
+    if old.get('version') != DECLARATIONS_VERSION or old.get('top') != top:
+        log.info("declaration index %s is of another version or tree, "
+                 "scanning all templates", filename)
+        return {}
+    return old['templates']
+
+
+def save_declarations(filename, top, declarations):
+    """Write the template declarations in filename atomically"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpfile = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as fdo:
+        json.dump({'version': DECLARATIONS_VERSION,
+                   'top': top,
+                   'templates': declarations}, fdo)
+    os.rename(tmpfile, filename)
+
+
+def scan_templates(top, filenames, index_file=None, jobs=1):
+    """
+    Return the template paths per base directory of the templates in
+    filenames, in the same order.
+
+    With an index_file, the declarations are kept there keyed by path,
+    size and mtime, and only new or changed templates are read again.
+    The templates are read by jobs threads.
+    """
+    known = dict()
+    if index_file is not None:
+        known = load_declarations(index_file, top)
+
+    declarations = dict()
+    changed = []
+    for filename in filenames:
+        st = os.stat(filename)
+        key = [st.st_size, st.st_mtime]
+        entry = known.get(filename)
+        if entry is not None and entry[:2] == key:
+            declarations[filename] = entry
+        else:
+            declarations[filename] = key
+            changed.append(filename)
+    log.info("%d of %d templates to scan", len(changed), len(filenames))
+
+    if jobs > 1 and len(changed) > SCAN_CHUNK_SIZE:
+        pool = ThreadPool(jobs)
+        try:
+            names = pool.map(scan_template_name, changed, SCAN_CHUNK_SIZE)
+            pool.close()
+        finally:
+            pool.terminate()
+    else:
+        names = [scan_template_name(filename) for filename in changed]
+    for filename, name in zip(changed, names):
+        declarations[filename].extend(detect_template_basedir(top, filename,
+                                                              name))
+
+    template_bases = defaultdict(list)
+    for filename in filenames:
+        basedir, tplpath = declarations[filename][2:]
+        template_bases[basedir].append(tplpath)
+
+    if index_file is not None:
+        save_declarations(index_file, top, declarations)
+    return template_bases
+
+
 def chunk_list(list_, chunk_size):
     for i in xrange(0, len(list_), chunk_size):
         yield list_[i:i + chunk_size]
@@ -395,6 +1071,36 @@ def main():
                         action="store_false", default=True,
                         help="Render immediately. Reduces memory usage, but "
                              "breaks cross referencing")
+    parser.add_argument("--two_pass", dest="two_pass", action="store_true",
+                        default=False,
+                        help="Build the indexes first and render every page "
+                             "from the annotation files afterwards. Reduces "
+                             "memory usage and keeps cross referencing")
+    parser.add_argument("--incremental", dest="incremental", metavar="DIR",
+                        help="Keep a build manifest and the annotations in "
+                             "DIR and only annotate and render the templates "
+                             "and pages that changed since the previous build "
+                             "with the same DIR and output directory")
+    parser.add_argument("--pipeline", dest="pipeline", action="store_true",
+                        default=False,
+                        help="Parse the annotation files as soon as "
+                             "panc-annotations writes them, while it is "
+                             "still running (not used with --incremental)")
+    parser.add_argument("--highlight_cache", dest="highlight_cache",
+                        metavar="DIR",
+                        help="Keep the highlighted template sources in DIR, "
+                             "so unchanged sources are highlighted only once "
+                             "over several builds")
+    parser.add_argument("--declaration_index", dest="declaration_index",
+                        metavar="FILE",
+                        help="Keep the template declarations found by the "
+                             "scan of the source tree in FILE, so only new "
+                             "and changed templates are read again (default: "
+                             "%s in the --incremental directory)"
+                             % DECLARATIONS_FILE)
+    parser.add_argument("-J", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of panc-annotations and render processes "
+                             "to run concurrently (default: %(default)s)")
     parser.add_argument("source", help="Directory where the templates can be found")
     parser.add_argument("output", help="Output directory")
     args = parser.parse_args()
@@ -409,6 +1115,21 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    incremental = args.incremental
+    if incremental is not None:
+        incremental = os.path.abspath(incremental)
+        if not os.path.exists(incremental):
+            os.makedirs(incremental)
+
+    declaration_index = args.declaration_index
+    if declaration_index is None and incremental is not None:
+        declaration_index = os.path.join(incremental, DECLARATIONS_FILE)
+    if declaration_index is not None:
+        declaration_index = os.path.abspath(declaration_index)
+
+    if args.highlight_cache is not None:
+        tpldocutils.set_highlight_cache_dir(os.path.abspath(args.highlight_cache))
+
     top = args.source
     # If the chdir fails, the exception is just what we want.
     os.chdir(top)
@@ -430,8 +1151,7 @@ def main():
 
     work_queue = []
 
-    template_bases = defaultdict(list)
-
+    templates = []
     for root, dirs, files in os.walk(top, topdown=True):
         # Make sure we don't descend into mgmt directories (e.g. .git)
         for i in range(len(dirs) - 1, -1, -1):
@@ -445,29 +1165,62 @@ def main():
             if not is_template(f):
                 continue
 
-            basedir, tplpath = detect_template_basedir(top, os.path.join(root, f))
-            template_bases[basedir].append(tplpath)
+            templates.append(os.path.join(root, f))
 
-    for relpath in sorted(template_bases.keys()):
-        log.info("scanning templates relative to %s", relpath)
-        tpls = template_bases[relpath]
-
-        if relpath == ".":
-            root = top
-        else:
-            root = os.path.join(top, relpath)
+    template_bases = scan_templates(top, templates, declaration_index,
+                                    args.jobs)
 
-        for chunk in chunk_list(tpls, 1000):
-            deferred = annotate(chunk, index, state, relpath, out,
-                                args.render_at_end)
-            if deferred:
-                work_queue.extend(deferred)
+    jobs = []
+    for relpath in sorted(template_bases.keys()):
+        for chunk in chunk_list(template_bases[relpath], CHUNK_SIZE):
+            jobs.append((chunk, relpath))
+
+    # The base directories and chunks are independent, so panc runs for
+    # up to args.jobs of them concurrently. The results are consumed in
+    # job order, so index, state and TEMPLATES_BYNAME are built as in a
+    # serial run.
+    # In pipeline mode, the annotation files are summarized while panc
+    # is still running. All panc output directories are made in
+    # tmpdir_base, so the ones of jobs that are not consumed after an
+    # error are removed as well.
+    tmpdir_base = tempfile.mkdtemp()
+    panc_jobs = [(chunk, relpath, tmpdir_base, args.pipeline) for chunk, relpath in jobs]
+    manifest = None
+    failed = 0
+    pool = ThreadPool(max(args.jobs, 1))
+    try:
+        if incremental is not None:
+            manifest, work_queue, failed = annotate_incremental(jobs, index, state, out,
+                                                                incremental, args.jobs)
+            work_queue = select_changed_pages(work_queue, index, manifest, out)
+            panc_jobs = []
+
+        for job, (tmpdir, errors, summaries, returncode) in run_panc_jobs(pool, panc_jobs, args.jobs):
+            chunk, relpath = job[:2]
+            if returncode != 0:
+                failed += 1
+            log.info("scanning %d templates relative to %s", len(chunk), relpath)
+            deferred = process_annotations(tmpdir, errors, index, state,
+                                           relpath, out,
+                                           args.render_at_end or args.two_pass,
+                                           args.two_pass, summaries)
+            work_queue.extend(deferred)
+        pool.close()
+
+        log.info("rendering html")
+        render_pages(work_queue, index, args.jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir_base, ignore_errors=True)
 
-    log.info("rendering html")
-    for (outfile, transform, args) in work_queue:
-        render_one(outfile, transform, args)
+    build_toplevels(out, index, manifest)
+    if manifest is not None:
+        save_manifest(incremental, manifest)
 
-    build_toplevels(out, index)
+    # Compile errors are shown on the pages, so they do not fail the build
+    if failed:
+        log.error("%s failed for %d of the template chunks", panc_annotations, failed)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
+import re
+
 from pygments.lexer import RegexLexer, bygroups, include
+from pygments.token import _TokenType
 from pygments.token import *
 
 
@@ -68,3 +71,168 @@ class PanLexer(RegexLexer):
             (r'\d+', Number.Integer)
         ],
     }
+
+
+# The states whose rules only match words, the fast lexer looks these
+# words up in a table instead of trying the regexes.
+WORD_STATES = ('keywords', 'autovars', 'builtins')
+IDENTIFIER = r'[a-zA-Z_][a-zA-Z0-9_]*'
+
+
+def expand_rules(lexer, state):
+    """Return the rules of a state with the included states expanded."""
+    rules = []
+    for rule in lexer.tokens[state]:
+        if isinstance(rule, include):
+            rules.extend(expand_rules(lexer, str(rule)))
+        else:
+            rules.append(rule)
+    return rules
+
+
+def shift_backrefs(regex, offset):
+    """Renumber the backreferences of a regex that ends up after offset groups."""
+    def shift(match):
+        if match.group(1) == '\\':
+            return match.group(0)
+        return '\\%d' % (int(match.group(1)) + offset)
+    return re.sub(r'\\(\\|\d+)', shift, regex)
+
+
+class FastPanLexer(PanLexer):
+    """
+    Lexer with the same token stream as PanLexer.
+
+    The rules of the root state are combined in a single regex, and the
+    rules of the word states are replaced by one identifier match and a
+    lookup of the identifier in a table.
+    """
+    name = 'Pan'
+    aliases = ['pan']
+    filenames = ['*.pan', '*.tpl']
+
+    root_regex = None
+    root_rules = None
+    words = None
+
+    @classmethod
+    def compile_root(cls):
+        """
+        Build the combined root regex, the index of the root rule of every
+        named group of it and the word table.
+        """
+        parts = []
+        rules = {}
+        words = {}
+        ngroups = 0
+        index = 0
+        for rule in cls.tokens['root']:
+            if isinstance(rule, include) and rule in WORD_STATES:
+                for regex, token in expand_rules(cls, str(rule)):
+                    if not (regex.startswith('(') and regex.endswith(r')\b')):
+                        raise ValueError("unexpected word rule %s" % regex)
+                    for word in regex[1:-3].split('|'):
+                        words.setdefault(word, token)
+                    index += 1
+                # the first rule after the word states
+                if 'identifier' not in rules:
+                    parts.append('(?P<identifier>%s)' % IDENTIFIER)
+                    ngroups += 1
+                rules['identifier'] = index
+                continue
+
+            if isinstance(rule, include):
+                expanded = expand_rules(cls, str(rule))
+            else:
+                expanded = [rule]
+            for regex in [r[0] for r in expanded]:
+                name = 'rule%d' % index
+                parts.append('(?P<%s>%s)' % (name, shift_backrefs(regex, ngroups + 1)))
+                ngroups += 1 + re.compile(regex, cls.flags).groups
+                rules[name] = index
+                index += 1
+
+        cls.root_regex = re.compile('|'.join(parts), cls.flags)
+        cls.root_rules = rules
+        cls.words = words
+
+    def get_tokens_unprocessed(self, text, stack=('root',)):
+        if self.root_regex is None:
+            self.compile_root()
+        tokendefs = self._tokens
+        rootdefs = tokendefs['root']
+        rootmatch = self.root_regex.match
+        rules = self.root_rules
+        words = self.words
+
+        pos = 0
+        statestack = list(stack)
+        statetokens = tokendefs[statestack[-1]]
+        while 1:
+            if statestack[-1] == 'root':
+                m = rootmatch(text, pos)
+                if m:
+                    name = m.lastgroup
+                    if name == 'identifier':
+                        word = m.group()
+                        if word in words:
+                            yield pos, words[word], word
+                            pos = m.end()
+                            continue
+                        # try the rules after the word states
+                        candidates = rootdefs[rules[name]:]
+                    else:
+                        rule = rootdefs[rules[name]]
+                        if type(rule[1]) is _TokenType and rule[2] is None:
+                            # the most common case
+                            yield pos, rule[1], m.group()
+                            pos = m.end()
+                            continue
+                        candidates = [rule]
+                else:
+                    candidates = []
+            else:
+                candidates = statetokens
+
+            for rexmatch, action, new_state in candidates:
+                m = rexmatch(text, pos)
+                if m:
+                    if action is not None:
+                        if type(action) is _TokenType:
+                            yield pos, action, m.group()
+                        else:
+                            for item in action(self, m):
+                                yield item
+                    pos = m.end()
+                    if new_state is not None:
+                        if isinstance(new_state, tuple):
+                            for state in new_state:
+                                if state == '#pop':
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif state == '#push':
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(state)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == '#push':
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                    break
+            else:
+                # no rule matched, like RegexLexer
+                try:
+                    if text[pos] == '\n':
+                        statestack = ['root']
+                        statetokens = tokendefs['root']
+                        yield pos, Text, u'\n'
+                        pos += 1
+                        continue
+                    yield pos, Error, text[pos]
+                    pos += 1
+                except IndexError:
+                    break
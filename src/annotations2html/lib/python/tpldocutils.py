@@ -1,20 +1,85 @@
+import os
 import re
+import codecs
+import hashlib
+import tempfile
+from collections import OrderedDict
 
+import pygments
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
-from panlexer import PanLexer
+from panlexer import FastPanLexer
 
 links = re.compile(r'\[(((https?)|(ftp))://.*)\]')
-lexer = PanLexer()
+lexer = FastPanLexer()
 formatter = HtmlFormatter(linenos=False, cssclass="pan")
 
+# Highlighted sources are cached in memory (the most recently used ones)
+# and optionally on disk, keyed by a hash of the source. Bump the version
+# when the lexer or the formatter options change.
+HIGHLIGHT_CACHE_VERSION = "1"
+HIGHLIGHT_CACHE_SIZE = 256
+highlight_cache = OrderedDict()
+highlight_cache_dir = None
+
 
 def styles():
     return formatter.get_style_defs('.pan')
 
 
+def set_highlight_cache_dir(directory):
+    """Keep the highlighted sources in directory as well, None disables it"""
+    global highlight_cache_dir
+    highlight_cache_dir = directory
+
+
+def highlight_key(code):
+    digest = hashlib.sha1()
+    digest.update("%s-%s\0" % (HIGHLIGHT_CACHE_VERSION, pygments.__version__))
+    if isinstance(code, unicode):
+        code = code.encode("utf-8")
+    digest.update(code)
+    return digest.hexdigest()
+
+
+def read_highlight_cache(key):
+    filename = os.path.join(highlight_cache_dir, key[:2], key + ".html")
+    try:
+        with codecs.open(filename, "r", encoding="utf-8") as fd:
+            return fd.read()
+    except IOError:
+        return None
+
+
+def write_highlight_cache(key, html):
+    directory = os.path.join(highlight_cache_dir, key[:2])
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another render process
+            if not os.path.isdir(directory):
+                raise
+    fd, tmpfile = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as fdo:
+        fdo.write(html.encode("utf-8"))
+    os.rename(tmpfile, os.path.join(directory, key + ".html"))
+
+
 def pan_markup(code):
-    return highlight(code, lexer, formatter)
+    key = highlight_key(code)
+    html = highlight_cache.pop(key, None)
+    if html is None and highlight_cache_dir is not None:
+        html = read_highlight_cache(key)
+    if html is None:
+        html = highlight(code, lexer, formatter)
+        if highlight_cache_dir is not None:
+            write_highlight_cache(key, html)
+
+    highlight_cache[key] = html
+    if len(highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+        highlight_cache.popitem(last=False)
+    return html
 
 
 def annotation_markup(text):
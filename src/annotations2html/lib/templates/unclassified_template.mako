@@ -15,57 +15,57 @@ ${title}
 <h2 class='code'>${title}</h2>
 </div>
 
-% if xml.findall("{%s}synopsis" % ns):
+% if summary['synopsis'] is not None:
 <div class='module secondary ltgray'>
 <h2>Synopsis</h2>
 <blockquote class='pan'>
-${tpldocutils.pan_markup(xml.findtext("{%s}synopsis" % ns))}
+${tpldocutils.pan_markup(summary['synopsis'])}
 </blockquote>
 </div>
 % endif
 
-% if xml.findtext("{%s}desc" % ns):
+% if summary['desc']:
 <div class='module secondary ltgray'>
 <h2>Description</h2>
 <p>
-${tpldocutils.annotation_markup(xml.findtext("{%s}desc" % ns))}
+${tpldocutils.annotation_markup(summary['desc'])}
 </div>
 % endif
 
-% if xml.findall("{%s}function" % ns):
+% if summary['functions']:
 <div class='module secondary ltgray'>
 <h2>Functions</h2>
 <dl compact='compact'>
-% for fn in sorted(xml.findall("{%s}function" % ns), key=lambda x: x.attrib['name'].lower()):
-<dt>${fn.attrib['name']}()</dt>
-% if 'desc' in fn.attrib:
-<dd>${fn.attrib['desc'] | h}</dd>
+% for name, desc in summary['functions']:
+<dt>${name}()</dt>
+% if desc is not None:
+<dd>${desc | h}</dd>
 % endif
 % endfor
 </dl>
 </div>
 % endif
 
-% if xml.findall("{%s}variable" % ns):
+% if summary['variables']:
 <div class='module secondary ltgray'>
 <h2>Global Variables</h2>
 <dl compact='compact'>
-% for var in sorted(xml.findall("{%s}variable" % ns), key=lambda x: x.attrib['name'].lower()):
-<dt>${var.attrib['name'] | h}</dt>
-% if 'desc' in var.attrib:
-<dd>${var.attrib['desc'] | h}</dd>
+% for name, desc in summary['variables']:
+<dt>${name | h}</dt>
+% if desc is not None:
+<dd>${desc | h}</dd>
 % endif
 % endfor
 </dl>
 </div>
 % endif
 
-% if xml.findall("{%s}see-also" % ns) or len(index[tplname]) > 1:
+% if summary['see-also'] is not None or len(index[tplname]) > 1:
 <div class='module secondary ltgray'>
 <h2>See Also</h2>
 <ul>
-% if xml.findall("{%s}see-also" % ns):
-<li>${tpldocutils.annotation_markup(xml.findtext("{%s}see-also" % ns))}
+% if summary['see-also'] is not None:
+<li>${tpldocutils.annotation_markup(summary['see-also'])}
 % endif
 % if len(index[tplname]) > 1:
 % for alt, text in sorted(index[tplname]):
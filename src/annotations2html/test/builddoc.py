@@ -0,0 +1,186 @@
+"""
+Test class for the incremental mode of build-doc.py.
+
+build-doc.py runs on a copy of the templates in testdata, with a stub
+panc-annotations. An incremental build has to write the same site as
+a full build of the same templates.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+
+BUILDDOC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'build-doc.py')
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+# Writes simple annotation xml for every template, like panc-annotations.
+# Templates with ERROR in them get a compile error, then it exits with 1.
+STUB_PANC_ANNOTATIONS = """#!%s
+import os
+import re
+import sys
+from xml.sax.saxutils import escape, quoteattr
+
+args = sys.argv[1:]
+outdir = args[args.index('--output-dir') + 1]
+files = [arg for arg in args if arg not in ('--output-dir', outdir)]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calls'), 'a') as fih:
+    fih.write('%%d\\n' %% len(files))
+
+NS = 'http://quattor.org/pan/annotations'
+failed = False
+for name in files:
+    source = open(name).read()
+    if 'ERROR' in source:
+        print('syntax error [%%s:5.1-5.8]' %% os.path.abspath(name))
+        print('  unexpected ;')
+        failed = True
+    body = []
+    match = re.search(r'@\\{(.*?)\\}', source, re.S)
+    if match:
+        body.append('<desc>%%s</desc>' %% escape(match.group(1).strip()))
+    for tag in ('section', 'title', 'synopsis', 'see-also'):
+        match = re.search(r'#\\s*%%s:\\s*(.+)' %% tag, source)
+        if match:
+            body.append('<%%s>%%s</%%s>' %% (tag, escape(match.group(1).strip()), tag))
+    for function in re.findall(r'^function\\s+(\\w+)', source, re.M):
+        body.append('<function name=%%s desc="returns %%s"/>' %% (quoteattr(function), function))
+    for variable in re.findall(r'^variable\\s+(\\w+)', source, re.M):
+        body.append('<variable name=%%s/>' %% quoteattr(variable))
+    attrs = ''
+    lines = source.split('\\n')
+    for number, line in enumerate(lines):
+        match = re.match(r'^\\s*(?:(?:object|structure|declaration|unique)\\s+)*template\\s+(\\S+)\\s*;', line)
+        if match:
+            attrs = ' name=%%s source-range="%%d.1-%%d.%%d"' %% (quoteattr(match.group(1)), number + 1,
+                                                              number + 1, len(line))
+            break
+    target = os.path.join(outdir, name + '.annotation.xml')
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    with open(target, 'w') as fih:
+        fih.write('<?xml version="1.0" encoding="UTF-8"?><template xmlns="%%s"%%s>%%s</template>' %%
+                  (NS, attrs, ''.join(body)))
+sys.exit(1 if failed else 0)
+"""
+
+
+def read_site(location):
+    """Return the content of all files of a site, without the lines which change with every build."""
+    site = {}
+    for root, dirs, files in os.walk(location):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path) as fih:
+                site[os.path.relpath(path, location)] = [line for line in fih
+                                                         if 'generated at' not in line and
+                                                         'command run was' not in line]
+    return site
+
+
+class BuildDocTest(TestCase):
+    """Test class for the incremental mode of build-doc.py."""
+
+    def setUp(self):
+        """Set up a copy of the templates and the stub panc-annotations."""
+        self.tmpdir = mkdtemp()
+        self.source = os.path.join(self.tmpdir, "src")
+        shutil.copytree(os.path.join(TESTDATA, "templates"), self.source)
+        self.bindir = os.path.join(self.tmpdir, "bin")
+        os.makedirs(self.bindir)
+        stub = os.path.join(self.bindir, "panc-annotations")
+        with open(stub, 'w') as fih:
+            fih.write(STUB_PANC_ANNOTATIONS % sys.executable)
+        os.chmod(stub, 0o755)
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, output, *options):
+        """Run build-doc.py on the templates, return its exit code and the number of templates passed to panc."""
+        calls = os.path.join(self.bindir, "calls")
+        if os.path.exists(calls):
+            os.remove(calls)
+        env = dict(os.environ)
+        env['PATH'] = "%s:%s" % (self.bindir, env.get('PATH', ''))
+        with open(os.devnull, 'w') as devnull:
+            ec = subprocess.call([sys.executable, BUILDDOC] + list(options) +
+                                 [self.source, os.path.join(self.tmpdir, output)],
+                                 env=env, stdout=devnull, stderr=devnull)
+        annotated = 0
+        if os.path.exists(calls):
+            with open(calls) as fih:
+                annotated = sum(int(line) for line in fih)
+        return ec, annotated
+
+    def assert_same_as_full_build(self, output):
+        """Check that output has the same site as a full build."""
+        full = os.path.join(self.tmpdir, "full")
+        if os.path.exists(full):
+            shutil.rmtree(full)
+        self.assertEqual(self.build("full")[0], 0)
+        self.assertEqual(read_site(os.path.join(self.tmpdir, output)), read_site(full))
+
+    def test_incremental_failing_template(self):
+        """Test an incremental build of templates panc fails on."""
+        incremental = os.path.join(self.tmpdir, "incremental")
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(ec, 0)
+        self.assertEqual(annotated, 7)
+        self.assert_same_as_full_build("out")
+
+        # The page of the failing template shows the panc error
+        site = read_site(os.path.join(self.tmpdir, "out"))
+        pages = [page for page, lines in site.items() if any('unexpected ;' in line for line in lines)]
+        self.assertEqual(len(pages), 1)
+
+        # Nothing is annotated again
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(annotated, 0)
+        self.assert_same_as_full_build("out")
+
+    def test_incremental_changes(self):
+        """Test incremental builds after templates are edited, added and removed."""
+        incremental = os.path.join(self.tmpdir, "incremental")
+        self.build("out", "--incremental", incremental)
+
+        # Edited template
+        with open(os.path.join(self.source, "os", "base.pan"), 'a') as fih:
+            fih.write("function os_release = { return('7.9'); };\n")
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(annotated, 1)
+        self.assert_same_as_full_build("out")
+
+        # New template in a new section
+        os.makedirs(os.path.join(self.source, "site", "extra"))
+        with open(os.path.join(self.source, "site", "extra", "repo.pan"), 'w') as fih:
+            fih.write("@{ Extra repositories. }\n# section: extra\ntemplate extra/repo;\n")
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(annotated, 1)
+        self.assert_same_as_full_build("out")
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "out", "extra.html")))
+
+        # Touched template with the same content
+        os.utime(os.path.join(self.source, "pan", "types.tpl"), (1000, 1000))
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(annotated, 0)
+        self.assert_same_as_full_build("out")
+
+        # Removed templates
+        shutil.rmtree(os.path.join(self.source, "site", "extra"))
+        os.remove(os.path.join(self.source, "features", "web", "config.pan"))
+        ec, annotated = self.build("out", "--incremental", incremental)
+        self.assertEqual(annotated, 0)
+        self.assert_same_as_full_build("out")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "out", "features.web.config.pan.annotation.html")))
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(BuildDocTest)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Test class for panlexer.
+
+The fast lexer has to produce exactly the token stream of PanLexer.
+Set PAN_TEMPLATES to a directory (e.g. a template library checkout)
+to compare both lexers over all templates in it as well.
+"""
+
+import os
+import sys
+import codecs
+import random
+from unittest import TestCase, main, TestLoader
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib/python')))  # noqa
+from panlexer import PanLexer, FastPanLexer
+from pygments.token import Keyword, Name, Punctuation, Text
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+# pieces of pan code, glued together at random
+FRAGMENTS = [
+    'template', 'unique template a/b;', 'structure template x;', 'object template y;',
+    'declaration template z;', 'function', 'function f = ', 'function\\ \n', 'if', 'iffy',
+    'if_exists(', 'length (', 'OBJECT', 'SELF', 'ARGV[0]', 'x', '_y1', '  ', '\n', '\t',
+    '# comment\n', '@{ annot } ', '@(paren)', '@( multi\nline )', '@{', '}', ')', '(',
+    '"str\\"ing"', "'s\\'q'", '"unterminated', "'", '1.5e3', '.5', '017', '0x1F', '12L', '42',
+    '<<EOF;\nbody\nEOF\n', '<<', '>>', '>=', '[]', '?=', '&&', '||', '&', '+=', '-', '~', '^',
+    ';', ',', '{', '[', ']', '<', '>', '/a/b', 'is_list', 'nlist', 'final', 'variable',
+    'include', 'prefix', 'null', 'true', 'boolean', 'type', 'bind', 'foreach(k;v;x)',
+    u'\xe9', '$', '`', '\\', 'template "q";', 'template\n',
+]
+
+
+class PanLexerTest(TestCase):
+    """Test class for panlexer."""
+
+    def setUp(self):
+        """Set up the lexers."""
+        self.lexer = PanLexer()
+        self.fastlexer = FastPanLexer()
+
+    def assertSameTokens(self, text, msg=None):
+        """Check both lexers produce the same tokens for text."""
+        expected = list(self.lexer.get_tokens_unprocessed(text))
+        self.assertEquals(list(self.fastlexer.get_tokens_unprocessed(text)), expected, msg)
+        self.assertEquals(list(self.fastlexer.get_tokens(text)), list(self.lexer.get_tokens(text)), msg)
+
+    def get_templates(self):
+        """Return the test templates, and the ones in PAN_TEMPLATES."""
+        templates = []
+        for root, dirs, files in sorted(os.walk(TESTDATA)):
+            templates.extend(os.path.join(root, f) for f in sorted(files))
+        schema = os.path.join(TESTDATA, '../../../documentation_builder/test/testdata/pan_annotated_schema.pan')
+        if os.path.exists(schema):
+            templates.append(schema)
+        if 'PAN_TEMPLATES' in os.environ:
+            for root, dirs, files in os.walk(os.environ['PAN_TEMPLATES']):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                templates.extend(os.path.join(root, f) for f in sorted(files) if f.endswith(('.pan', '.tpl')))
+        return templates
+
+    def test_templates(self):
+        """Test both lexers on real templates."""
+        for template in self.get_templates():
+            with codecs.open(template, 'r', encoding='utf-8', errors='replace') as fih:
+                self.assertSameTokens(fih.read(), template)
+
+    def test_fragments(self):
+        """Test both lexers on random pan code."""
+        rand = random.Random(1)
+        for _ in range(2000):
+            text = u''.join(rand.choice(FRAGMENTS) for _ in range(rand.randint(0, 30)))
+            self.assertSameTokens(text, repr(text))
+
+    def test_words(self):
+        """Test the word lookup of the fast lexer."""
+        tokens = list(self.fastlexer.get_tokens_unprocessed(u'unique if_exists iffy OBJECT length (x'))
+        self.assertEquals(tokens, [
+            (0, Keyword.Reserved, u'unique'),
+            (6, Text, u' '),
+            (7, Name.Builtin, u'if_exists'),
+            (16, Text, u' '),
+            (17, Name, u'iffy'),
+            (21, Text, u' '),
+            (22, Name.Variable, u'OBJECT'),
+            (28, Text, u' '),
+            (29, Name.Builtin, u'length'),
+            (35, Text, u' '),
+            (36, Punctuation, u'('),
+            (37, Name, u'x'),
+        ])
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(PanLexerTest)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+# deliberately odd input, the lexer has to recover from it
+declaration template "quoted/name";
+structure template
+  odd;
+object template odd/object;
+function
+  broken = { return(`backtick`) };
+@( single line paren annotation )
+@( multi
+   line annotation )
+'unterminated string
+"unicode ◊ é"
+$ \ 0x 09 .e5 1.
+iffy if_exists foreachx OBJECTS SELF_ _x1
+@{ unterminated annotation
@@ -0,0 +1,6 @@
+@{ Some types. }
+# synopsis: common types
+declaration template pan/types;
+
+variable DEFAULT_PORT ?= 0x1F;
+function is_port = { return(ARGV[0] < 65536); };
@@ -0,0 +1,325 @@
+#!/usr/bin/env python2
+"""
+Benchmark the documentation-builder pipeline.
+
+Generates synthetic repositories with pod, pm and pan files and runs the
+stages of the builder on them, one after the other:
+ - list_source_files
+ - generate_rst
+ - cleanup_content
+ - build_site_structure
+ - write_site
+Stub pod2rst, pod2rst-batch and panc-annotations executables are used, so
+it runs offline and measures the builder itself rather than perl or java.
+For every stage the wall time, the cpu time of the stub processes, the
+number of files and the peak memory (maximum resident set size of the
+process, so far) are reported.
+@author: Wouter Depypere (Ghent University)
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from vsc.utils import fancylogger
+from vsc.utils.generaloption import simple_option
+from quattordocbuild.builder import make_titles, build_site_structure, write_site
+from quattordocbuild.config import build_repository_map
+from quattordocbuild.rsthandler import generate_rst, cleanup_content
+from quattordocbuild.sourcehandler import list_source_files
+
+logger = fancylogger.getLogger()
+
+STAGES = ['list_source_files', 'generate_rst', 'cleanup_content', 'build_site_structure', 'write_site']
+
+CONFIG = """[docbuilder]
+sitesection=%s
+targets=/NCM/Component/,/pan/quattor/
+"""
+
+PARAGRAPH = """Paragraph %(index)s of %(name)s, configured in /software/components/%(name)s/config
+and maintained by admin%(index)s@example.org, see also /etc/%(name)s/%(name)s.conf for the
+generated file. Contact someone.else@quattor.org for more information.
+"""
+
+POD = """=pod
+
+=head1 NAME
+
+%(name)s - synthetic documentation
+
+=head1 DESCRIPTION
+
+%(paragraphs)s
+=cut
+"""
+
+PM = """#${PMpre} NCM::Component::%(name)s${PMpost}
+
+use parent qw(NCM::Component);
+
+sub Configure
+{
+    my ($self, $config) = @_;
+    return 1;
+}
+
+1;
+
+%(pod)s"""
+
+PAN = """declaration template quattor/%(name)s/schema;
+
+@documentation{
+    desc = synthetic type %(name)s
+}
+type %(name)s_component = {
+%(fields)s} = dict();
+"""
+
+FIELD = """    @{field %(index)s of %(name)s}
+    'field%(index)s' %(required)s %(type)s%(range)s%(default)s
+"""
+
+STUB_POD2RST = """#!%(python)s
+import sys
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+try:
+    content = open(args['--infile']).read()
+except IOError:
+    sys.exit(1)
+title = args['--title']
+sys.stdout.write("%%s\\n%%s\\n\\n%%s" %% (title, '=' * len(title), content))
+"""
+
+STUB_POD2RST_BATCH = """#!%(python)s
+import sys
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if not line:
+        continue
+    infile, title = line.split('\\t', 1)
+    try:
+        content = "%%s\\n%%s\\n\\n%%s" %% (title, '=' * len(title), open(infile).read())
+        ec = 0
+    except IOError:
+        content = ''
+        ec = 1
+    sys.stdout.write("==POD2RST-BATCH== %%s %%s\\n%%s" %% (ec, len(content), content))
+"""
+
+STUB_PANC_ANNOTATIONS = """#!%(python)s
+import os
+import re
+import sys
+
+NS = 'http://quattor.org/pan/annotations'
+FIELD = re.compile(r"^\\s*'(\\w+)' ([:?]) (\\w+)(\\(([\\d.]+)\\))?( = (\\S+))?")
+TYPE = re.compile(r'^type (\\w+) =')
+args = sys.argv[1:]
+options = {'--output-dir': '.', '--base-dir': '.'}
+files = []
+while args:
+    arg = args.pop(0)
+    if arg in options:
+        options[arg] = args.pop(0)
+    else:
+        files.append(arg)
+outputdir, basedir = options['--output-dir'], options['--base-dir']
+for pfile in files:
+    fields = []
+    types = []
+    for line in open(os.path.join(basedir, pfile)):
+        match = TYPE.match(line)
+        if match:
+            types.append(match.group(1))
+        match = FIELD.match(line)
+        if match:
+            fields.append(match.groups())
+    xml = ['<?xml version="1.0" encoding="UTF-8"?><template xmlns="%%s" name="schema">' %% NS]
+    for name in types:
+        xml.append('<type name="%%s"><documentation><desc>synthetic type</desc></documentation><basetype>' %% name)
+        for fname, required, ftype, dummy, frange, dummy2, default in fields:
+            required = str(required == ':').lower()
+            xml.append('<field name="%%s" required="%%s"><desc>field %%s</desc>' %% (fname, required, fname))
+            xml.append('<basetype name="%%s"%%s/>' %% (ftype, frange and ' range="%%s"' %% frange or ''))
+            if default:
+                xml.append('<default text="%%s"/>' %% default.strip('"'))
+            xml.append('</field>')
+        xml.append('</basetype></type>')
+    xml.append('</template>')
+    target = os.path.join(outputdir, '%%s.annotation.xml' %% pfile)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    with open(target, 'w') as fih:
+        fih.write(''.join(xml))
+"""
+
+
+def write_file(path, content, mode=None):
+    """Write a file, making its directory if needed."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fih:
+        fih.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def make_pod(name, size):
+    """Return pod documentation with size paragraphs."""
+    paragraphs = "\n".join(PARAGRAPH % {'index': index, 'name': name} for index in range(size))
+    return POD % {'name': name, 'paragraphs': paragraphs}
+
+
+def make_pan(name, size):
+    """Return a pan schema with a type with size fields."""
+    fields = []
+    for index in range(size):
+        fieldtype, frange, default = [("long", "(0..%s)" % (index + 1), " = %s" % index),
+                                      ("string", "", ' = "value%s"' % index),
+                                      ("boolean", "", "")][index % 3]
+        fields.append(FIELD % {'index': index, 'name': name, 'required': ':?'[index % 2], 'type': fieldtype,
+                               'range': frange, 'default': default})
+    return PAN % {'name': name, 'fields': "".join(fields)}
+
+
+def generate_repositories(location, repositories, pods, pms, pans, size):
+    """
+    Generate synthetic repositories in location.
+
+    Every repository has pods pod files, pms perl modules and pans pan schemas,
+    with size paragraphs or fields each.
+    """
+    for repo in range(repositories):
+        reponame = "repo%s" % repo
+        repodir = os.path.join(location, reponame)
+        write_file(os.path.join(repodir, ".docbuilder.cfg"), CONFIG % reponame)
+        for index in range(pods):
+            name = "podcomp%s" % index
+            write_file(os.path.join(repodir, "ncm-%s" % name, "target", "doc", "pod", "NCM", "Component",
+                                    "%s.pod" % name), make_pod(name, size))
+        for index in range(pms):
+            name = "pmcomp%s" % index
+            write_file(os.path.join(repodir, "ncm-%s" % name, "target", "lib", "perl", "NCM", "Component",
+                                    "%s.pm" % name), PM % {'name': name, 'pod': make_pod(name, size)})
+        for index in range(pans):
+            name = "pancomp%s" % index
+            write_file(os.path.join(repodir, "ncm-%s" % name, "target", "pan", "quattor", name, "schema.pan"),
+                       make_pan(name, size))
+
+
+def install_stubs(location):
+    """Install the stub executables in location and put it first in PATH."""
+    for name, content in [("pod2rst", STUB_POD2RST), ("pod2rst-batch", STUB_POD2RST_BATCH),
+                          ("panc-annotations", STUB_PANC_ANNOTATIONS)]:
+        write_file(os.path.join(location, name), content % {'python': sys.executable}, 0o755)
+    os.environ['PATH'] = "%s:%s" % (location, os.environ.get('PATH', ''))
+
+
+def measure(stage, report, function, *args):
+    """Run function as a stage of the benchmark, add its measurements to report."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    result = function(*args)
+    walltime = time.time() - start
+    newchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = report.setdefault(stage, {'time': 0.0, 'subprocess_time': 0.0, 'files': 0, 'maxrss_kb': 0})
+    stats['time'] += walltime
+    stats['subprocess_time'] += (newchildren.ru_utime + newchildren.ru_stime) - (children.ru_utime + children.ru_stime)
+    stats['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run_benchmark(location, output, cleanup_options, batch_size=0):
+    """Run all stages on the repositories in location, writing the site in output, return the report."""
+    report = {}
+    repository_map = build_repository_map(location)
+    rstlist = {}
+    for repository in sorted(repository_map):
+        fullpath = os.path.join(location, repository)
+        sources = measure('list_source_files', report, list_source_files, fullpath)
+        report['list_source_files']['files'] += len(sources)
+        sources = make_titles(sources, repository_map[repository]['targets'])
+
+        rst = measure('generate_rst', report, generate_rst, sources, batch_size)
+        report['generate_rst']['files'] += len(rst)
+
+        measure('cleanup_content', report, cleanup_content, rst, cleanup_options)
+        report['cleanup_content']['files'] += len(rst)
+        rstlist[repository] = rst
+
+    sitepages = measure('build_site_structure', report, build_site_structure, rstlist, repository_map)
+    pages = sum(len(subpages) for subpages in sitepages.values())
+    report['build_site_structure']['files'] = pages
+
+    measure('write_site', report, write_site, sitepages, output, "docs")
+    report['write_site']['files'] = pages
+    return report
+
+
+def print_report(report):
+    """Print the report as a table."""
+    print "%-22s %10s %12s %8s %12s" % ("stage", "time (s)", "subproc (s)", "files", "maxrss (KiB)")
+    for stage in STAGES:
+        stats = report[stage]
+        print "%-22s %10.3f %12.3f %8d %12d" % (stage, stats['time'], stats['subprocess_time'], stats['files'],
+                                                stats['maxrss_kb'])
+
+
+def main(options):
+    """Generate the repositories, run the benchmark and report."""
+    location = options.location
+    if location is None:
+        location = tempfile.mkdtemp(prefix="docbuild-benchmark-")
+    elif not os.path.isdir(location):
+        os.makedirs(location)
+
+    try:
+        repositories = os.path.join(location, "repositories")
+        if not os.path.isdir(repositories):
+            logger.info("Generating repositories in %s." % repositories)
+            generate_repositories(repositories, options.repositories, options.pods, options.pms, options.pans,
+                                  options.size)
+        install_stubs(os.path.join(location, "bin"))
+
+        cleanup_options = {
+            'remove_emails': options.remove_emails,
+            'codify_paths': options.codify_paths,
+        }
+        output = os.path.join(location, "output")
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        report = run_benchmark(repositories, output, cleanup_options, options.pod2rst_batch)
+        print_report(report)
+        if options.report:
+            with open(options.report, 'w') as fih:
+                json.dump(report, fih, indent=2, sort_keys=True)
+    finally:
+        if options.location is None:
+            shutil.rmtree(location)
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'location': ('Directory for the synthetic repositories, they are reused if they exist (default: a '
+                     'temporary directory, removed afterwards).', None, 'store', None, 'l'),
+        'repositories': ('Number of repositories.', 'int', 'store', 2),
+        'pods': ('Number of pod files per repository.', 'int', 'store', 200),
+        'pms': ('Number of perl modules per repository.', 'int', 'store', 200),
+        'pans': ('Number of pan schemas per repository.', 'int', 'store', 50),
+        'size': ('Number of paragraphs per perl file and fields per pan schema.', 'int', 'store', 20),
+        'pod2rst_batch': ('Convert perl files with pod2rst-batch, this many files per process (0 disables it).',
+                          'int', 'store', 0),
+        'remove_emails': ('Remove email addresses from generated rst files.', None, 'store_true', True, 'r'),
+        'codify_paths': ('Put paths inside code tags.', None, 'store_true', True, 'p'),
+        'report': ('Write the report as JSON to this file.', None, 'store', None),
+    }
+    GO = simple_option(OPTIONS)
+    main(GO.options)
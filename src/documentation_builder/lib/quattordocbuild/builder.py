@@ -4,61 +4,236 @@ import os
 import sys
 import re
 import codecs
+import shutil
+import glob
+import filecmp
+import tempfile
 from sourcehandler import get_source_files
 from rsthandler import generate_rst, cleanup_content
+from cachehandler import split_cached, update_cache
 from config import build_repository_map
+from panhandler import set_pan_backend
+import panhandler
+from instrumentation import stage, count, reset, collect, merge, log_report, write_report
 from vsc.utils import fancylogger
 from multiprocessing import Pool
 
 logger = fancylogger.getLogger()
 RESULTS = {}
+CHUNK_SIZE = 25
+
+def build_documentation(repository_location, cleanup_options, compile, output_location, singlet=False,
+                        cache_location=None, batch_size=0, workers=None, chunk_size=CHUNK_SIZE, stream=False,
+                        interlink=False, report_file=None, update=False, pan_backend='panc'):
+    """
+    Build the whole documentation from quattor repositories.
+
+    In stream mode, pages are written as soon as they are generated and
+    only the page names are kept in memory.
+    In update mode, the output location does not have to be empty: the site is
+    built in a staging directory and moved in place of the old one at the end,
+    unchanged pages keep their modification time and stale pages are gone.
+    pan_backend selects how the documentation of pan files is extracted,
+    with panc-annotations (panc) or in process (python).
+    The timings and counters of all stages are logged at the end,
+    and written as a JSON report to report_file if it is set.
+    """
+    reset()
+    with stage('build'):
+        build_site(repository_location, cleanup_options, compile, output_location, singlet, cache_location,
+                   batch_size, workers, chunk_size, stream, interlink, update, pan_backend)
+    log_report()
+    if report_file:
+        write_report(report_file)
+    return True
+
 
-def build_documentation(repository_location, cleanup_options, compile, output_location, singlet=False):
-    """Build the whole documentation from quattor repositories."""
-    if not check_input(repository_location, output_location):
+def build_site(repository_location, cleanup_options, compile, output_location, singlet, cache_location,
+               batch_size, workers, chunk_size, stream, interlink, update, pan_backend):
+    """Build the site, see build_documentation."""
+    if not check_input(repository_location, output_location, update):
         sys.exit(1)
-    if not check_commands(compile):
+    if not set_pan_backend(pan_backend):
+        sys.exit(1)
+    if cache_location and not os.path.isdir(cache_location):
+        logger.info("Creating cache location %s." % cache_location)
+        os.makedirs(cache_location)
+    if not check_commands(compile, batch_size):
         sys.exit(1)
     repository_map = build_repository_map(repository_location)
     if not repository_map:
         sys.exit(1)
 
-    rstlist = {}
+    site_location = output_location
+    if update:
+        restore_site(output_location, "docs")
+        site_location = tempfile.mkdtemp(prefix=".staging-", dir=output_location)
+    try:
+        write_docs(repository_location, repository_map, cleanup_options, compile, site_location, singlet,
+                   cache_location, batch_size, workers, chunk_size, stream, interlink)
+        if update:
+            with stage('swap_site'):
+                swap_site(site_location, output_location, "docs")
+    finally:
+        if update:
+            shutil.rmtree(site_location, ignore_errors=True)
+
+
+def write_docs(repository_location, repository_map, cleanup_options, compile, output_location, singlet,
+               cache_location, batch_size, workers, chunk_size, stream, interlink):
+    """Build the documentation of all repositories and write the site to output_location."""
+    stream_location = None
+    if stream:
+        stream_location = output_location
 
     if singlet:
         for repository in repository_map.keys():
-            repository, result = build_docs(repository, repository_location, repository_map, cleanup_options)
-            RESULTS[repository] = result
+            repository, result = build_docs(repository, repository_location, repository_map, cleanup_options,
+                                            cache_location, batch_size, compile)
+            store_result(repository, result, repository_map, stream_location)
     else:
-        pool = Pool()
-        for repository in repository_map.keys():
-            pool.apply_async(build_docs, args=(repository, repository_location, repository_map, cleanup_options), callback = log_result)
-        pool.close()
-        pool.join()
+        build_docs_parallel(repository_location, repository_map, cleanup_options, compile, cache_location,
+                            batch_size, workers, chunk_size, stream_location)
 
     site_pages = build_site_structure(RESULTS, repository_map)
-    # site_pages = make_interlinks(site_pages) # disabled for now
-    write_site(site_pages, output_location, "docs")
-    return True
-
-def log_result(result):
-    repository = result[0]
-    result = result[1]
-    RESULTS[repository] = result
-
-def build_docs(repository, repository_location, repository_map, cleanup_options):
+    if stream:
+        if interlink:
+            with stage('interlink'):
+                interlink_site(site_pages, output_location, "docs")
+    else:
+        if interlink:
+            with stage('interlink'):
+                site_pages = make_interlinks(site_pages)
+        with stage('write_site'):
+            write_site(site_pages, output_location, "docs")
+
+
+def store_result(repository, rst, repository_map, stream_location=None):
+    """
+    Store the rst of (a part of) a repository in RESULTS.
+
+    If stream_location is set, the pages are written out right away
+    and only the source names are kept, as a manifest for the site structure.
+    """
+    if stream_location:
+        with stage('write_site', repository):
+            write_site(build_site_structure({repository: rst}, repository_map), stream_location, "docs")
+        rst = dict.fromkeys(rst)
+    RESULTS.setdefault(repository, {}).update(rst)
+
+
+def build_docs(repository, repository_location, repository_map, cleanup_options, cache_location=None,
+               batch_size=0, maven_compile=False):
+    """Build the documentation of a single repository."""
+    repository, sources = collect_sources(repository, repository_location, repository_map, maven_compile,
+                                          cache_location)
+    return generate_docs(repository, sources, cleanup_options, cache_location, batch_size)
+
+
+def build_docs_parallel(repository_location, repository_map, cleanup_options, maven_compile, cache_location,
+                        batch_size, workers, chunk_size, stream_location=None):
+    """
+    Build the documentation of all repositories with one shared pool of workers.
+
+    The source files of all repositories are split in chunks, idle workers pick up the next chunk,
+    so a large repository is spread over all workers. Every chunk starts its own panc-annotations
+    or pod2rst-batch process, so pan files are split in chunks of panhandler.CHUNK_SIZE files
+    (with panc) and perl files in chunks of batch_size files (if set), the rest in chunks of chunk_size.
+    The results are reassembled per repository in RESULTS, the statistics of the workers are merged.
+    """
+    pool = Pool(workers)
+    collected = []
+    for result, stats in pool.map(run_task, [(collect_sources, repository, repository_location, repository_map,
+                                              maven_compile, cache_location) for repository in repository_map.keys()]):
+        collected.append(result)
+        merge(stats)
+    tasks = []
+    pan_chunk_size = chunk_size
+    if panhandler.PAN_BACKEND == 'panc':
+        pan_chunk_size = panhandler.CHUNK_SIZE
+    for repository, chunk in make_chunks(collected, chunk_size, pan_chunk_size, batch_size or chunk_size):
+        tasks.append((generate_docs, repository, chunk, cleanup_options, cache_location, batch_size))
+    logger.info("Generating rst in %s chunks." % len(tasks))
+
+    for repository in repository_map.keys():
+        RESULTS[repository] = {}
+    for (repository, rst), stats in pool.imap_unordered(run_task, tasks):
+        merge(stats)
+        store_result(repository, rst, repository_map, stream_location)
+    pool.close()
+    pool.join()
+
+
+def run_task(task):
+    """
+    Run a task in a pool worker, task is a tuple of a function and its arguments.
+
+    Returns the result and the statistics of the task.
+    """
+    reset()
+    return task[0](*task[1:]), collect()
+
+
+def make_chunks(collected, chunk_size, pan_chunk_size=None, perl_chunk_size=None):
+    """
+    Split the sources of all repositories in chunks of a single source type.
+
+    Pan files are split in chunks of at most pan_chunk_size sources, perl files
+    in chunks of at most perl_chunk_size sources (both chunk_size by default).
+    The largest repositories come first, so they do not end up as the long tail of the build.
+    """
+    chunks = []
+    for repository, sources in sorted(collected, key=lambda repo: len(repo[1]), reverse=True):
+        items = sorted(sources.items())
+        panitems = [item for item in items if item[1].endswith(".pan")]
+        perlitems = [item for item in items if not item[1].endswith(".pan")]
+        for typeitems, size in [(panitems, pan_chunk_size or chunk_size), (perlitems, perl_chunk_size or chunk_size)]:
+            for index in range(0, len(typeitems), size):
+                chunks.append((repository, dict(typeitems[index:index + size])))
+    return chunks
+
+
+def collect_sources(repository, repository_location, repository_map, maven_compile=False, cache_location=None):
+    """
+    Return the source files of a repository, with their titles as keys.
+
+    If cache_location is set, the source file index of the repository is kept there.
+    """
     logger.info("Building documentation for %s." % repository)
     fullpath = os.path.join(repository_location, repository)
     if repository_map[repository]["subdir"]:
         fullpath = os.path.join(fullpath, repository_map[repository]["subdir"])
     logger.info("Path: %s." % fullpath)
-    sources = get_source_files(fullpath, compile)
+    index_file = None
+    if cache_location:
+        index_file = os.path.join(cache_location, "sources-%s.json" % repository)
+    with stage('collect_sources', repository):
+        sources = get_source_files(fullpath, maven_compile, index_file)
     logger.debug("Sources: %s" % sources)
-    sources = make_titles(sources, repository_map[repository]['targets'])
-    rst = generate_rst(sources)
-    cleanup_content(rst, cleanup_options)
+    if sources is None:
+        return repository, {}
+    return repository, make_titles(sources, repository_map[repository]['targets'])
+
+
+def generate_docs(repository, sources, cleanup_options, cache_location=None, batch_size=0):
+    """Generate and clean up the rst for sources of a repository."""
+    with stage('generate_docs', repository):
+        cached = {}
+        if cache_location:
+            with stage('cache'):
+                cached, sources, keys = split_cached(sources, cleanup_options, cache_location, batch_size)
+        failures = set()
+        rst = generate_rst(sources, batch_size, failures)
+        with stage('cleanup_content'):
+            cleanup_content(rst, cleanup_options)
+            count('files', len(rst))
+        if cache_location:
+            with stage('cache'):
+                update_cache(keys, rst, cache_location, failures)
+            rst.update(cached)
     return repository, rst
 
+
 def which(command):
     """Check if given command is available for the current user on this system."""
     found = False
@@ -69,8 +244,12 @@ def which(command):
     return found
 
 
-def check_input(sourceloc, outputloc):
-    """Check input and locations."""
+def check_input(sourceloc, outputloc, update=False):
+    """
+    Check input and locations.
+
+    The output location has to be empty, unless the site is updated.
+    """
     logger.info("Checking if the given paths exist.")
     if not sourceloc:
         logger.error("Repo location not specified.")
@@ -84,20 +263,23 @@ def check_input(sourceloc, outputloc):
     if not os.path.exists(outputloc):
         logger.error("Output location %s does not exist" % outputloc)
         return False
-    if not os.listdir(outputloc) == []:
+    if not update and not os.listdir(outputloc) == []:
         logger.error("Output location %s is not empty." % outputloc)
         return False
     return True
 
 
-def check_commands(runmaven):
+def check_commands(runmaven, batch=False):
     """Check required binaries."""
     if runmaven:
         if not which("mvn"):
             logger.error("The command mvn is not available on this system, please install maven.")
             return False
-    if not which("pod2rst"):
-        logger.error("The command pod2rst is not available on this system, please install pod2rst.")
+    pod2rst = "pod2rst"
+    if batch:
+        pod2rst = "pod2rst-batch"
+    if not which(pod2rst):
+        logger.error("The command %s is not available on this system, please install %s." % (pod2rst, pod2rst))
         return False
     return True
 
@@ -173,44 +355,96 @@ def build_site_structure(rstlist, repository_map):
 
 
 def make_interlinks(pages):
-    """Make links in the content based on pagenames."""
+    """
+    Make links in the content based on pagenames.
+
+    All link forms of all pages are combined in a single regex,
+    so every page is rewritten in one pass.
+    """
     logger.info("Creating interlinks.")
-    newpages = pages
+    linkregex, links = build_link_regex(pages)
+    if linkregex is None:
+        return pages
+
+    for subdir in pages:
+        for page in pages[subdir]:
+            pages[subdir][page] = replace_links(linkregex, links, page, pages[subdir][page])
+
+    return pages
+
+
+def interlink_site(sitepages, location, docsdir):
+    """Make links in pages which are already written to disk, one page at a time."""
+    logger.info("Creating interlinks in %s." % os.path.join(location, docsdir))
+    linkregex, links = build_link_regex(sitepages)
+    if linkregex is None:
+        return
+
+    for subdir, pages in sitepages.iteritems():
+        for page in pages:
+            pagefile = os.path.join(location, docsdir, subdir, page)
+            with codecs.open(pagefile, 'r', encoding='utf-8') as fih:
+                content = fih.read()
+            newcontent = replace_links(linkregex, links, page, content)
+            if newcontent != content:
+                with codecs.open(pagefile, 'w', encoding='utf-8') as fih:
+                    fih.write(newcontent)
+
+
+def get_link_forms(subdir, basename):
+    """Return the ways a page can be referred to in the content of other pages."""
+    forms = []
+    forms.append("`%s`" % basename)
+    forms.append("`%s::%s`" % (subdir, basename))
+
+    cpans = "https://metacpan.org/pod/"
+
+    if subdir == 'CCM':
+        forms.append("[{2}::{0}]({1}{2}::{0})".format(basename, cpans, "EDG::WP4::CCM"))
+    if subdir == 'Unittest':
+        forms.append("[{2}::{0}]({1}{2}::{0})".format(basename, cpans, "Test"))
+    if subdir in ['components', 'components-grid']:
+        forms.append("[{2}::{0}]({1}{2}::{0})".format(basename, cpans, "NCM::Component"))
+        forms.append("`ncm-%s`" % basename)
+        forms.append("ncm-%s" % basename)
+
+    return forms
+
+
+def build_link_regex(pages):
+    """
+    Build one regex matching every link form of every page.
+
+    Returns the compiled regex and a dict with (basename, link) per link form,
+    None if there is nothing to link to. If several pages share a link form, the first one wins.
+    """
+    links = {}
     for subdir in pages:
         for page in pages[subdir]:
             basename = os.path.splitext(page)[0]
             link = '../%s/%s' % (subdir, page)
-            regxs = []
-            regxs.append("`%s`" % basename)
-            regxs.append("`%s::%s`" % (subdir, basename))
-
-            cpans = "https://metacpan.org/pod/"
+            for form in get_link_forms(subdir, basename):
+                links.setdefault(form, (basename, link))
 
-            if subdir == 'CCM':
-                regxs.append("\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "EDG::WP4::CCM"))
-            if subdir == 'Unittest':
-                regxs.append("\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "Test"))
-            if subdir in ['components', 'components-grid']:
-                regxs.append("\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "NCM::Component"))
-                regxs.append("`ncm-%s`" % basename)
-                regxs.append("ncm-%s" % basename)
+    if not links:
+        return None, links
 
-            for regex in regxs:
-                newpages = replace_regex_link(newpages, regex, basename, link)
+    # longest forms first, so a form never shadows a longer one starting with it
+    forms = sorted(links, key=len, reverse=True)
+    linkregex = re.compile(r'( |^|\n)(%s)(?=[,. $])' % "|".join(re.escape(form) for form in forms))
+    return linkregex, links
 
-    return newpages
 
+def replace_links(linkregex, links, page, content):
+    """Replace all link forms in the content of a page, pages do not link to themselves."""
+    def replace(match):
+        """Return the link for a match."""
+        basename, link = links[match.group(2)]
+        if basename in page and basename != "Quattor":
+            return match.group(0)
+        return "%s[%s](%s)" % (match.group(1), basename, link)
 
-def replace_regex_link(pages, regex, basename, link):
-    """Replace links in a bunch of pages based on a regex."""
-    regex = r'( |^|\n)%s([,. $])' % regex
-    for subdir in pages:
-        for page in pages[subdir]:
-            content = pages[subdir][page]
-            if (basename not in page or basename == "Quattor") and basename in content:
-                content = re.sub(regex, "\g<1>[%s](%s)\g<2>" % (basename, link), content)
-                pages[subdir][page] = content
-    return pages
+    return linkregex.sub(replace, content)
 
 
 def write_site(sitepages, location, docsdir):
@@ -222,3 +456,71 @@ def write_site(sitepages, location, docsdir):
         for pagename, content in pages.iteritems():
             with codecs.open(os.path.join(fullsubdir, pagename), 'w', encoding='utf-8') as fih:
                 fih.write(content)
+            count('files')
+            count('bytes_written', len(content))
+
+
+def swap_site(staging, location, docsdir):
+    """
+    Replace the docsdir in location by the one built in staging.
+
+    Pages with the same content as before get their old modification time back,
+    so tools like sphinx only rebuild the changed pages. Pages which are not
+    in the new site are removed with the old tree.
+    This takes two renames, so it is not atomic: in between there is no docsdir.
+    If moving the new tree in place fails, the old tree is moved back. Otherwise the
+    old tree ends up in staging, which is removed by the caller. If the build is
+    killed in between, the next update puts the old tree back (see restore_site).
+    """
+    newdir = os.path.join(staging, docsdir)
+    olddir = os.path.join(location, docsdir)
+    backup = None
+    if not os.path.isdir(newdir):
+        os.makedirs(newdir)
+    if os.path.isdir(olddir):
+        preserve_unchanged(newdir, olddir)
+        backup = os.path.join(staging, "%s.old" % docsdir)
+        os.rename(olddir, backup)
+    logger.info("Moving the new site to %s." % olddir)
+    try:
+        os.rename(newdir, olddir)
+    except OSError:
+        if backup is not None:
+            logger.error("Could not move the new site to %s, restoring the old site." % olddir)
+            os.rename(backup, olddir)
+        raise
+
+
+def restore_site(location, docsdir):
+    """
+    Put back the old docsdir of an update which was interrupted while swapping the site.
+
+    Returns True if a site was restored.
+    """
+    if os.path.exists(os.path.join(location, docsdir)):
+        return False
+    for backup in sorted(glob.glob(os.path.join(location, ".staging-*", "%s.old" % docsdir))):
+        logger.warning("Restoring the site of an interrupted update from %s." % backup)
+        os.rename(backup, os.path.join(location, docsdir))
+        return True
+    return False
+
+
+def preserve_unchanged(newdir, olddir):
+    """Give pages in newdir with the same content as in olddir the modification time of the old page."""
+    oldpages = set()
+    for path, dirs, files in os.walk(olddir):
+        oldpages.update(os.path.relpath(os.path.join(path, name), olddir) for name in files)
+
+    for path, dirs, files in os.walk(newdir):
+        for name in files:
+            newpage = os.path.join(path, name)
+            page = os.path.relpath(newpage, newdir)
+            oldpage = os.path.join(olddir, page)
+            if page in oldpages and filecmp.cmp(newpage, oldpage, shallow=False):
+                shutil.copystat(oldpage, newpage)
+                count('unchanged')
+            else:
+                count('changed')
+            oldpages.discard(page)
+    count('removed', len(oldpages))
@@ -0,0 +1,167 @@
+"""
+Module to handle the incremental rebuild cache.
+
+Generated rst is stored on disk, keyed by a hash of the source content,
+the title, the cleanup options and what renders it (the pan template, the
+pan backend and the pod2rst or panc-annotations executables). Sources which
+did not change since the previous run are taken from the cache, so only
+the dirty ones have to go through pod2rst or panc-annotations again.
+Sources which failed to convert are not cached, so they are retried.
+"""
+
+import os
+import json
+import errno
+import codecs
+import hashlib
+import tempfile
+
+from vsc.utils import fancylogger
+import panhandler
+import panextractor
+from panhandler import get_basename
+from instrumentation import count
+
+logger = fancylogger.getLogger()
+CACHE_VERSION = '2'
+# renderer identities, they do not change during a run
+RENDERERS = {}
+
+
+def get_cache_key(source, title, cleanup_options, renderer=''):
+    """Return the cache key for a source file with a title, cleanup options and renderer identity."""
+    digest = hashlib.sha256()
+    digest.update(CACHE_VERSION)
+    digest.update(renderer)
+    with open(source, 'rb') as fih:
+        for block in iter(lambda: fih.read(65536), b''):
+            digest.update(block)
+    digest.update(title.encode('utf-8'))
+    for option in sorted(cleanup_options):
+        digest.update("%s=%s" % (option, bool(cleanup_options[option])))
+    # the output of pan files also depends on the component name in the path
+    if source.endswith('.pan'):
+        digest.update(get_basename(source))
+    return digest.hexdigest()
+
+
+def get_file_digest(filename):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fih:
+        digest.update(fih.read())
+    return digest.hexdigest()
+
+
+def get_command_identity(command):
+    """Return the identity of a command in PATH: its real path, size and modification time."""
+    for directory in os.getenv("PATH", "").split(':'):
+        path = os.path.join(directory, command)
+        if os.path.exists(path):
+            path = os.path.realpath(path)
+            stat = os.stat(path)
+            return "%s:%s:%s" % (path, stat.st_size, stat.st_mtime)
+    return "%s:missing" % command
+
+
+def get_renderer(source, batch_size=0):
+    """
+    Return the identity of what turns source into rst.
+
+    For pan files that is the pan template and the pan backend (the
+    panc-annotations executable or the panextractor module), for perl
+    files the pod2rst (and pod2rst-batch) executables.
+    """
+    if source.endswith('.pan'):
+        kind = ('pan', panhandler.PAN_BACKEND)
+    else:
+        kind = ('perl', bool(batch_size))
+    if kind not in RENDERERS:
+        if kind[0] == 'pan':
+            parts = [kind[1], get_file_digest(os.path.join(panhandler.TEMPLATE_DIR, 'pan.j2'))]
+            if kind[1] == 'panc':
+                parts.append(get_command_identity("panc-annotations"))
+            else:
+                parts.append(get_file_digest(os.path.splitext(panextractor.__file__)[0] + '.py'))
+        else:
+            parts = [get_command_identity("pod2rst")]
+            if kind[1]:
+                parts.append(get_command_identity("pod2rst-batch"))
+        RENDERERS[kind] = "\n".join(parts)
+    return RENDERERS[kind]
+
+
+def get_cache_file(location, key):
+    """Return the path of the cache file for a key."""
+    return os.path.join(location, key[:2], "%s.json" % key)
+
+
+def read_cache(location, key):
+    """
+    Read a cache entry.
+
+    Returns a tuple (hit, rst), rst is None for sources which did not produce usable rst.
+    """
+    cachefile = get_cache_file(location, key)
+    if not os.path.isfile(cachefile):
+        return False, None
+    try:
+        with codecs.open(cachefile, 'r', encoding='utf-8') as fih:
+            entry = json.load(fih)
+    except (IOError, ValueError) as err:
+        logger.warning("Could not read cache file %s: %s." % (cachefile, err))
+        return False, None
+    return True, entry['rst']
+
+
+def write_cache(location, key, rst):
+    """Write a cache entry atomically, rst can be None."""
+    cachefile = get_cache_file(location, key)
+    cachedir = os.path.dirname(cachefile)
+    try:
+        os.makedirs(cachedir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    if isinstance(rst, str):
+        rst = rst.decode('utf-8', 'replace')
+    fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fih:
+        json.dump({'rst': rst}, fih)
+    os.rename(tmpfile, cachefile)
+
+
+def split_cached(sources, cleanup_options, location, batch_size=0):
+    """
+    Split sources in cached and dirty sources.
+
+    batch_size is the pod2rst-batch batch size the dirty sources are converted with.
+
+    Returns the cached rst per source, the dirty sources (title: source)
+    and the cache keys of those dirty sources.
+    """
+    cached = {}
+    dirty = {}
+    keys = {}
+    for title, source in sources.iteritems():
+        key = get_cache_key(source, title, cleanup_options, get_renderer(source, batch_size))
+        hit, rst = read_cache(location, key)
+        if hit:
+            if rst is not None:
+                cached[source] = rst
+        else:
+            dirty[title] = source
+            keys[source] = key
+
+    logger.info("Found %s cached and %s dirty source files." % (len(sources) - len(dirty), len(dirty)))
+    count('cache_hits', len(sources) - len(dirty))
+    count('cache_misses', len(dirty))
+    return cached, dirty, keys
+
+
+def update_cache(keys, rst, location, failures=()):
+    """Store the rst of the previously dirty sources in the cache, except for the ones in failures."""
+    for source, key in keys.iteritems():
+        if source in failures:
+            continue
+        write_cache(location, key, rst.get(source))
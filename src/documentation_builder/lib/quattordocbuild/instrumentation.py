@@ -0,0 +1,163 @@
+"""
+Module to instrument the documentation build.
+
+Every stage of the build records its wall time, the cpu time spent in
+subprocesses (maven, pod2rst, panc) and counters like files, bytes read
+and written and failures, per repository.
+Stages can be nested, a nested stage belongs to the repository of the
+stage around it and its time is part of the time of that stage as well.
+The subprocess time of a stage is the cpu time of all child processes
+that were waited for during the stage, including their own children.
+In the main process this includes the pool workers reaped at the end of
+the build, so the subprocess time of the build stage overlaps with the
+subprocess time the workers report for their stages.
+
+Worker processes return their statistics with their results, those are
+merged in the main process, which writes the report at the end of the build.
+"""
+
+import os
+import json
+import time
+import resource
+import tempfile
+from contextlib import contextmanager
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+# statistics per repository (None for the site as a whole) and stage
+STATS = {}
+# stack of the active (repository, stage) pairs
+ACTIVE = []
+# the last exception counted as a failure, so enclosing stages do not count it again
+FAILURE = None
+
+
+def get_counters(repository, stagename):
+    """Return the counters of a stage of a repository."""
+    stages = STATS.setdefault(repository, {})
+    if stagename not in stages:
+        stages[stagename] = {'calls': 0, 'time': 0.0, 'subprocess_time': 0.0}
+    return stages[stagename]
+
+
+def get_subprocess_time():
+    """Return the cpu time used by the finished subprocesses so far."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def stage(stagename, repository=None):
+    """
+    Measure a stage of the build.
+
+    Without a repository, the stage belongs to the repository of the active stage.
+    A stage which raises an exception counts as a failure, an exception raised
+    in nested stages only counts for the innermost one.
+    The subprocess time is the cpu time of the child processes that finished
+    during the stage (see the module documentation).
+    """
+    global FAILURE
+    if repository is None and ACTIVE:
+        repository = ACTIVE[-1][0]
+    ACTIVE.append((repository, stagename))
+    start = time.time()
+    subprocess_start = get_subprocess_time()
+    try:
+        yield
+    except Exception as err:
+        if FAILURE is not err:
+            FAILURE = err
+            count('failures')
+        raise
+    finally:
+        ACTIVE.pop()
+        counters = get_counters(repository, stagename)
+        counters['calls'] += 1
+        counters['time'] += time.time() - start
+        counters['subprocess_time'] += get_subprocess_time() - subprocess_start
+
+
+def count(name, value=1):
+    """Add value to the counter name of the active stage."""
+    repository, stagename = None, 'other'
+    if ACTIVE:
+        repository, stagename = ACTIVE[-1]
+    counters = get_counters(repository, stagename)
+    counters[name] = counters.get(name, 0) + value
+
+
+def count_file_size(name, filename):
+    """Add the size of a file to the counter name of the active stage, if it exists."""
+    try:
+        count(name, os.path.getsize(filename))
+    except OSError:
+        pass
+
+
+def reset():
+    """Drop all statistics, e.g. at the start of a task in a worker process."""
+    global FAILURE
+    STATS.clear()
+    del ACTIVE[:]
+    FAILURE = None
+
+
+def collect():
+    """Return the statistics, to be merged in the main process."""
+    return STATS
+
+
+def merge(stats):
+    """Merge statistics of a worker process."""
+    for repository, stages in stats.iteritems():
+        for stagename, counters in stages.iteritems():
+            target = get_counters(repository, stagename)
+            for name, value in counters.iteritems():
+                target[name] = target.get(name, 0) + value
+
+
+def get_report():
+    """
+    Return the report of the build.
+
+    It has the statistics of the site as a whole, per repository and
+    the totals per stage over all repositories.
+    """
+    report = {
+        'site': STATS.get(None, {}),
+        'repositories': dict((repository, stages) for repository, stages in STATS.iteritems()
+                             if repository is not None),
+        'stages': {},
+    }
+    for stages in report['repositories'].values():
+        for stagename, counters in stages.iteritems():
+            total = report['stages'].setdefault(stagename, {})
+            for name, value in counters.iteritems():
+                total[name] = total.get(name, 0) + value
+    return report
+
+
+def write_report(filename):
+    """Write the report as JSON, atomically."""
+    logger.info("Writing build report to %s." % filename)
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fih:
+        json.dump(get_report(), fih, indent=2, sort_keys=True)
+    os.rename(tmpfile, filename)
+
+
+def log_report():
+    """Log the totals per stage."""
+    report = get_report()
+    stages = dict(report['stages'])
+    stages.update(report['site'])
+    for stagename in sorted(stages):
+        counters = stages[stagename]
+        logger.info("Stage %s: %.2fs, %.2fs in subprocesses, %s." %
+                    (stagename, counters['time'], counters['subprocess_time'],
+                     ", ".join("%s %s" % (name, value) for name, value in sorted(counters.items())
+                               if name not in ('time', 'subprocess_time'))))
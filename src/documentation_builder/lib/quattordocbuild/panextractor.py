@@ -0,0 +1,368 @@
+"""
+Extract the documentation of types and functions from pan source.
+
+A pure python alternative for panc-annotations: the pan source is scanned
+directly into the structure parse_type and parse_function of panhandler return
+(names, field types, required flags, ranges, defaults, descriptions and function
+arguments), without starting a java process or writing and parsing XML.
+"""
+
+import re
+import codecs
+
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+ANNOTATION_DELIMITERS = {'{': '}', '(': ')', '[': ']', '<': '>'}
+OPENING = '([{'
+CLOSING = ')]}'
+
+TOKENREGEX = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<comment>\#[^\n]*)
+    |(?P<annotation>@(?P<name>[A-Za-z_][\w]*)?\s*(?P<open>[{(\[<]))
+    |(?P<heredoc><<(?P<quote>['"]?)(?P<tag>[A-Za-z_]\w*)(?P=quote);?[^\n]*\n)
+    |(?P<string>'[^']*'|"(?:\\.|[^"\\])*")
+    |(?P<number>0[xX][0-9a-fA-F]+L?|(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?L?)
+    |(?P<word>[A-Za-z_][\w]*)
+    |(?P<punct>\.\.|.)
+""", re.VERBOSE | re.DOTALL)
+
+KEYVALUEREGEX = re.compile(r'^\s*(\w+)\s*=\s*(.*)$')
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', '\\': '\\'}
+
+
+class Token(object):
+    """A token of pan source, with its position in the source."""
+
+    def __init__(self, kind, text, start, end, value=None, name=None):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+        self.value = value
+        self.name = name
+
+    def __repr__(self):
+        return "Token(%s, %r)" % (self.kind, self.text)
+
+
+def tokenize(source):
+    """Return the tokens of pan source, without whitespace and comments."""
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = TOKENREGEX.match(source, position)
+        kind = match.lastgroup
+        if match.group('space') is not None:
+            kind = 'space'
+        elif match.group('comment') is not None:
+            kind = 'comment'
+        elif match.group('annotation') is not None:
+            kind = 'annotation'
+        elif match.group('heredoc') is not None:
+            kind = 'heredoc'
+        start, end = match.span()
+
+        if kind == 'annotation':
+            close = source.find(ANNOTATION_DELIMITERS[match.group('open')], end)
+            if close < 0:
+                close = len(source)
+            tokens.append(Token(kind, source[start:close + 1], start, close + 1, source[end:close],
+                                match.group('name')))
+            end = close + 1
+        elif kind == 'heredoc':
+            endtag = re.compile(r'^%s$' % re.escape(match.group('tag')), re.M)
+            close = endtag.search(source, end)
+            if close is None:
+                close_start = close_end = len(source)
+            else:
+                close_start, close_end = close.span()
+            tokens.append(Token('string', source[start:close_end], start, close_end, source[end:close_start]))
+            end = close_end
+        elif kind == 'string':
+            tokens.append(Token(kind, match.group(), start, end, unquote(match.group())))
+        elif kind not in ('space', 'comment'):
+            tokens.append(Token(kind, match.group(), start, end))
+        position = end
+    return tokens
+
+
+def unquote(text):
+    """Return the value of a pan string literal."""
+    if text.startswith("'"):
+        return text[1:-1]
+    return re.sub(r'\\(.)', lambda match: ESCAPES.get(match.group(1), match.group(1)), text[1:-1])
+
+
+def parse_annotations(annotations):
+    """
+    Return the documentation of an element from its annotations.
+
+    Unnamed annotations are the description, documentation annotations
+    have key = value lines (or are a description as a whole).
+    Returns the description and the list of arguments.
+    """
+    desc = None
+    documentation_desc = None
+    args = []
+    for annotation in annotations:
+        if annotation.name is None:
+            if desc is None:
+                desc = annotation.value
+        elif annotation.name == 'documentation':
+            values = parse_key_values(annotation.value)
+            if values is None:
+                values = [('desc', annotation.value)]
+            for key, value in values:
+                if key == 'desc' and documentation_desc is None:
+                    documentation_desc = value
+                elif key == 'arg':
+                    args.append(value)
+    if documentation_desc is not None:
+        desc = documentation_desc
+    return desc, args
+
+
+def parse_key_values(text):
+    """Return the key = value pairs of an annotation, None if it is not in key = value form."""
+    values = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = KEYVALUEREGEX.match(line)
+        if match:
+            values.append([match.group(1), match.group(2)])
+        elif values:
+            values[-1][1] += "\n%s" % line
+        else:
+            return None
+    if not values:
+        return None
+    return [tuple(value) for value in values]
+
+
+def cleanup_description(desc):
+    """Put a description on a single line."""
+    return " ".join(desc.replace('\n', '').replace('\r', '').split())
+
+
+class Parser(object):
+    """Parse the types and functions of pan source."""
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.position = 0
+
+    def peek(self, offset=0):
+        """Return the token at offset from the current position, None at the end."""
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None
+
+    def next(self):
+        """Return the current token and move on."""
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def is_punct(self, text, offset=0):
+        """Check if the token at offset is the punctuation text."""
+        token = self.peek(offset)
+        return token is not None and token.kind == 'punct' and token.text == text
+
+    def skip_expression(self, is_end):
+        """Skip tokens up to a token at depth 0 for which is_end returns True, return the skipped tokens."""
+        skipped = []
+        depth = 0
+        while self.peek() is not None:
+            token = self.peek()
+            if depth == 0 and is_end(token):
+                break
+            if token.kind == 'punct':
+                if token.text in OPENING:
+                    depth += 1
+                elif token.text in CLOSING:
+                    if depth == 0:
+                        break
+                    depth -= 1
+            skipped.append(self.next())
+        return skipped
+
+    def parse(self):
+        """Return the types and functions, as lists of dicts."""
+        types = []
+        functions = []
+        annotations = []
+        while self.peek() is not None:
+            token = self.peek()
+            if token.kind == 'annotation':
+                annotations.append(self.next())
+            elif token.kind == 'word' and token.text == 'type' and self.peek(1) is not None \
+                    and self.peek(1).kind == 'word' and self.is_punct('=', 2):
+                name = self.peek(1).text
+                self.position += 3
+                types.append(self.parse_type(name, annotations))
+                annotations = []
+            elif token.kind == 'word' and token.text == 'function' and self.peek(1) is not None \
+                    and self.peek(1).kind == 'word' and self.is_punct('=', 2):
+                functions.append(self.parse_function(self.peek(1).text, annotations))
+                self.skip_statement()
+                annotations = []
+            else:
+                self.skip_statement()
+                annotations = []
+        return types, functions
+
+    def skip_statement(self):
+        """Skip the current statement, including the semicolon."""
+        self.skip_expression(lambda token: token.kind == 'punct' and token.text == ';')
+        self.next()
+
+    def parse_type(self, name, annotations):
+        """Parse a type declaration after the equal sign."""
+        typeinfo = {'name': name}
+        desc, dummy = parse_annotations(annotations)
+        if desc is not None:
+            typeinfo['desc'] = cleanup_description(desc)
+        typeinfo['fields'] = []
+        self.parse_typespec(typeinfo['fields'])
+        self.skip_statement()
+        return typeinfo
+
+    def parse_function(self, name, annotations):
+        """Return the information of a function declaration."""
+        functinfo = {'name': name}
+        desc, args = parse_annotations(annotations)
+        if desc is not None:
+            functinfo['desc'] = cleanup_description(desc)
+        functinfo['args'] = [cleanup_description(arg) for arg in args]
+        return functinfo
+
+    def parse_typespec(self, fields):
+        """
+        Parse a type specification, add the fields of (nested) records to fields.
+
+        Returns the name and range of the base type, the name is None for records.
+        """
+        name = None
+        typerange = None
+        if self.peek() is not None and self.peek().kind == 'word' and self.peek().text == 'extensible':
+            self.next()
+        if self.is_punct('{'):
+            self.next()
+            self.parse_record(fields)
+        elif self.peek() is not None and self.peek().kind == 'word':
+            name = self.next().text
+            if self.is_punct('('):
+                start = self.next().end
+                self.skip_expression(lambda token: False)
+                close = self.next()
+                end = len(self.source) if close is None else close.start
+                typerange = "".join(self.source[start:end].split())
+        # list and dict suffixes
+        while self.is_punct('[') or (self.is_punct('{') and self.is_punct('}', 1)):
+            self.next()
+            self.skip_expression(lambda token: False)
+            self.next()
+        return name, typerange
+
+    def parse_record(self, fields):
+        """Parse the fields of a record, up to and including the closing brace."""
+        annotations = []
+        while self.peek() is not None and not self.is_punct('}'):
+            token = self.peek()
+            if token.kind == 'annotation':
+                annotations.append(self.next())
+            elif self.is_field_start():
+                self.parse_field(annotations, fields)
+                annotations = []
+            else:
+                # include of another record, or something unexpected
+                self.next()
+                annotations = []
+        self.next()
+
+    def is_field_start(self, offset=0):
+        """Check if a field starts at offset: a name followed by : or ?."""
+        token = self.peek(offset)
+        return (token is not None and token.kind in ('string', 'word') and
+                (self.is_punct(':', offset + 1) or self.is_punct('?', offset + 1)))
+
+    def parse_field(self, annotations, fields):
+        """Add the information of a field of a record to fields, followed by its nested fields."""
+        token = self.next()
+        fieldinfo = {'name': token.value if token.kind == 'string' else token.text}
+        desc, dummy = parse_annotations(annotations)
+        if desc is not None:
+            fieldinfo['desc'] = cleanup_description(desc)
+        fieldinfo['required'] = 'true' if self.next().text == ':' else 'false'
+
+        nested = []
+        fieldtype, typerange = self.parse_typespec(nested)
+        fieldinfo['type'] = fieldtype
+        if fieldtype == "long" and typerange:
+            fieldinfo['range'] = typerange
+
+        if self.is_punct('='):
+            self.next()
+            default = self.skip_expression(lambda token: self.is_field_end(token) or
+                                           (token.kind == 'word' and token.text == 'with'))
+            fieldinfo['default'] = default_text(self.source, default)
+        # the validation
+        self.skip_expression(self.is_field_end)
+        fields.append(fieldinfo)
+        fields.extend(nested)
+
+    def is_field_end(self, token):
+        """Check if token ends the field: the next field, its annotation or an include."""
+        return (token.kind == 'annotation' or (token.kind == 'word' and token.text == 'include') or
+                self.is_field_start())
+
+
+def default_text(source, tokens):
+    """Return the text of a default value, the value itself for literals."""
+    if len(tokens) == 1:
+        token = tokens[0]
+        if token.kind == 'string':
+            return token.value
+        if token.kind == 'number':
+            return number_text(token.text)
+    if not tokens:
+        return ''
+    return " ".join(source[tokens[0].start:tokens[-1].end].split())
+
+
+def number_text(text):
+    """Return a pan number literal in decimal notation, doubles are kept as they are."""
+    text = text.rstrip('L')
+    if text.lower().startswith('0x'):
+        return str(int(text, 16))
+    if re.match(r'^0[0-7]+$', text):
+        return str(int(text, 8))
+    if re.match(r'^\d+$', text):
+        return str(int(text))
+    return text
+
+
+def get_content_from_source(source):
+    """
+    Return the information of all types and functions in pan source.
+
+    The result is the same as get_content_from_annotations for the panc-annotations output.
+    """
+    content = {}
+    types, functions = Parser(source).parse()
+    if types or functions:
+        content['types'] = types
+        content['functions'] = functions
+    return content
+
+
+def get_content_from_panfile(panfile):
+    """Return the information of all types and functions in a pan file."""
+    with codecs.open(panfile, 'r', encoding='utf-8', errors='replace') as fih:
+        source = fih.read()
+    return get_content_from_source(source)
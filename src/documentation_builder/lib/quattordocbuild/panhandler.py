@@ -7,16 +7,41 @@ import shutil
 import jinja2
 from vsc.utils import fancylogger
 from vsc.utils.run import asyncloop
+from instrumentation import stage, count, count_file_size
+from panextractor import get_content_from_panfile
 from lxml import etree
 
 logger = fancylogger.getLogger()
 namespace = "{http://quattor.org/pan/annotations}"
+TYPE_TAG = "%stype" % namespace
+FUNCTION_TAG = "%sfunction" % namespace
+FIELD_TAG = "%sfield" % namespace
+BASETYPE_TAG = "%sbasetype" % namespace
+DEFAULT_TAG = "%sdefault" % namespace
+DESC_TAG = "%sdesc" % namespace
+DOCUMENTATION_TAG = "%sdocumentation" % namespace
+ARG_TAG = "%sarg" % namespace
+CHUNK_SIZE = 1000
+# panc runs panc-annotations, python extracts the documentation in process
+PAN_BACKENDS = ['panc', 'python']
+PAN_BACKEND = 'panc'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jinja')
+# One environment per process, made by get_jinja_env: templates are compiled once and kept in memory.
+JINJA_ENV = None
+
+
+def rst_from_pan(panfile, title, content=None):
+    """
+    Make reStructuredText from a pan annotated file.
 
-
-def rst_from_pan(panfile, title):
-    """Make reStructuredText from a pan annotated file."""
+    If the content was already collected (e.g. by get_contents_from_pans), it is not built again.
+    Returns None if there is no content.
+    """
     logger.info("Making rst from pan: %s." % panfile)
-    content = get_content_from_pan(panfile)
+    if content is None:
+        content = get_content_from_pan(panfile)
+    if content is None:
+        return None
     basename = get_basename(panfile)
     output = render_template(content, basename, title)
     if len(output) == 0:
@@ -25,51 +50,215 @@ def rst_from_pan(panfile, title):
         return output
 
 
+def set_pan_backend(backend):
+    """Select the backend to get the documentation from pan files, returns False for an unknown backend."""
+    global PAN_BACKEND
+    if backend not in PAN_BACKENDS:
+        logger.error("Unknown pan backend %s, use one of %s." % (backend, ", ".join(PAN_BACKENDS)))
+        return False
+    PAN_BACKEND = backend
+    return True
+
+
+def get_jinja_env():
+    """Return the jinja2 environment of this process, it is made on first use."""
+    global JINJA_ENV
+    if JINJA_ENV is None:
+        JINJA_ENV = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), trim_blocks=True,
+                                       lstrip_blocks=True, auto_reload=False)
+    return JINJA_ENV
+
+
 def render_template(content, basename, title):
     """Render the template."""
-    name = 'pan.j2'
-    loader = jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jinja'))
-    jenv = jinja2.Environment(loader=loader, trim_blocks=True, lstrip_blocks=True)
-    template = jenv.get_template('pan.j2')
+    template = get_jinja_env().get_template('pan.j2')
     output = template.render(content=content, basename=basename, title=title)
     return output
 
 
 def get_content_from_pan(panfile):
-    """Return the information of all types and functions from a pan annotated file."""
-    content = {}
+    """Return the information of all types and functions from a pan annotated file, None if that failed."""
+    if PAN_BACKEND == 'python':
+        return extract_content_from_pan(panfile)
+    content = None
     tempdir = tempfile.mkdtemp()
     directory, filename = os.path.split(panfile)
     built = build_annotations(filename, directory, tempdir)
     if built:
-        xmlroot = validate_annotations(os.path.join(tempdir, "%s.annotation.xml" % filename))
-        if xmlroot is not None:
-            types, functions = get_types_and_functions(xmlroot)
-            if types is not None:
-                content['types'] = []
-                for ptype in types:
-                    content['types'].append(parse_type(ptype))
-
-            if functions is not None:
-                content['functions'] = []
-                for function in functions:
-                    content['functions'].append(parse_function(function))
+        content = get_content_from_annotations(os.path.join(tempdir, "%s.annotation.xml" % filename))
     shutil.rmtree(tempdir)
     return content
 
 
-def build_annotations(pfile, basedir, outputdir):
-    """Build pan annotations."""
+def get_contents_from_pans(panfiles):
+    """
+    Return the information of all types and functions for a list of pan annotated files.
+
+    panc-annotations runs once per chunk of CHUNK_SIZE files instead of once per file.
+    Files of a chunk that failed are built one by one, so errors stay limited to the faulty files.
+    The information is None for the files that failed.
+    """
+    contents = {}
+    if not panfiles:
+        return contents
+    if PAN_BACKEND == 'python':
+        for panfile in panfiles:
+            contents[panfile] = extract_content_from_pan(panfile)
+        return contents
+
+    basedir = get_common_basedir(panfiles)
+    tempdir = tempfile.mkdtemp()
+    panfiles = sorted(panfiles)
+    for index in range(0, len(panfiles), CHUNK_SIZE):
+        chunk = panfiles[index:index + CHUNK_SIZE]
+        relpaths = [os.path.relpath(panfile, basedir) for panfile in chunk]
+        built = build_annotations(relpaths, basedir, tempdir)
+        for panfile, relpath in zip(chunk, relpaths):
+            if built:
+                contents[panfile] = get_content_from_annotations(os.path.join(tempdir, "%s.annotation.xml" % relpath))
+            else:
+                contents[panfile] = get_content_from_pan(panfile)
+    shutil.rmtree(tempdir)
+    return contents
+
+
+def extract_content_from_pan(panfile):
+    """Return the information of all types and functions from a pan file without panc-annotations, None on errors."""
+    with stage('pan_extract'):
+        count('files')
+        count_file_size('bytes_read', panfile)
+        try:
+            return get_content_from_panfile(panfile)
+        except (IOError, OSError) as err:
+            logger.warning("Could not read %s: %s." % (panfile, err))
+            count('failures')
+            return None
+
+
+def get_common_basedir(paths):
+    """Return the deepest directory containing all given paths."""
+    prefix = os.path.commonprefix([os.path.dirname(path) + os.sep for path in paths])
+    return prefix[:prefix.rfind(os.sep) + 1] or os.curdir
+
+
+def get_content_from_annotations(xmlfile):
+    """
+    Return the information of all types and functions from a pan annotations XML file.
+
+    The file is read with iter_annotations, the result is the same as
+    parse_type and parse_function give for the parsed tree.
+    """
+    content = {}
+    count_file_size('xml_bytes_read', xmlfile)
+    for kind, info in iter_annotations(xmlfile):
+        if not content:
+            content = {'types': [], 'functions': []}
+        content[kind].append(info)
+    if not content:
+        logger.debug("%s has no usable content, skipping it." % xmlfile)
+    return content
+
+
+def iter_annotations(xmlfile):
+    """
+    Read a pan annotations XML file in a single pass, yield ('types', typeinfo) and ('functions', functinfo).
+
+    Every type and function is yielded as soon as its end tag is read,
+    its elements are dropped afterwards, so memory use does not grow with the file.
+    """
+    kind = None
+    # open type or function and its fields: [element, info, desc, documentation desc]
+    owners = []
+    # open fields still looking for their first basetype and default
+    untyped = []
+    nodefault = []
+    depth = 0
+    for event, element in etree.iterparse(xmlfile, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            tag = element.tag
+            if depth == 2:
+                if tag == TYPE_TAG:
+                    kind = 'types'
+                    owners.append([element, {'name': element.get('name'), 'fields': []}, None, None])
+                elif tag == FUNCTION_TAG:
+                    kind = 'functions'
+                    owners.append([element, {'name': element.get('name'), 'args': []}, None, None])
+            elif kind == 'types':
+                if tag == FIELD_TAG:
+                    info = {'name': element.get('name'), 'required': element.get('required')}
+                    owners[0][1]['fields'].append(info)
+                    owners.append([element, info, None, None])
+                    untyped.append(info)
+                    nodefault.append(info)
+                elif tag == BASETYPE_TAG and untyped:
+                    fieldtype = element.get('name')
+                    for info in untyped:
+                        info['type'] = fieldtype
+                        if fieldtype == "long" and element.get('range'):
+                            info['range'] = element.get('range')
+                    untyped = []
+                elif tag == DEFAULT_TAG and nodefault:
+                    for info in nodefault:
+                        info['default'] = element.get('text')
+                    nodefault = []
+            continue
+
+        depth -= 1
+        if kind is not None:
+            tag = element.tag
+            owner = owners[-1]
+            if tag == DESC_TAG:
+                parent = element.getparent()
+                if parent is owner[0]:
+                    if owner[2] is None:
+                        owner[2] = element.text
+                elif parent.tag == DOCUMENTATION_TAG and parent.getparent() is owner[0] and owner[3] is None:
+                    owner[3] = element.text
+            elif tag == ARG_TAG and kind == 'functions':
+                owner[1]['args'].append(cleanup_description(element.text))
+            elif element is owner[0]:
+                owners.pop()
+                info = owner[1]
+                desc = owner[2]
+                if owner[3] is not None:
+                    desc = owner[3]
+                if desc is not None:
+                    info['desc'] = cleanup_description(desc)
+                if untyped and untyped[-1] is info:
+                    untyped.pop()
+                if nodefault and nodefault[-1] is info:
+                    nodefault.pop()
+                if not owners:
+                    yield kind, info
+                    kind = None
+
+        if depth == 1:
+            # done with a child of the root element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def build_annotations(pfiles, basedir, outputdir):
+    """Build pan annotations for one file or a list of files relative to basedir."""
+    if isinstance(pfiles, basestring):
+        pfiles = [pfiles]
     panccommand = ["panc-annotations", "--output-dir", outputdir, "--base-dir", basedir]
-    panccommand.append(pfile)
+    panccommand.extend(pfiles)
     logger.debug("Running %s." % panccommand)
-    ec, output = output = asyncloop(panccommand)
-    logger.debug(output)
-    if ec == 0 and os.path.exists(os.path.join(outputdir, "%s.annotation.xml" % pfile)):
-        return True
-    else:
-        logger.warning("Something went wrong running '%s'." % panccommand)
-        return False
+    with stage('panc'):
+        count('files', len(pfiles))
+        for pfile in pfiles:
+            count_file_size('bytes_read', os.path.join(basedir, pfile))
+        ec, output = output = asyncloop(panccommand)
+        logger.debug(output)
+        if ec == 0 and all(os.path.exists(os.path.join(outputdir, "%s.annotation.xml" % pfile)) for pfile in pfiles):
+            return True
+        else:
+            logger.warning("Something went wrong running '%s'." % panccommand)
+            count('failures')
+            return False
 
 
 def validate_annotations(pfile):
@@ -1,10 +1,12 @@
 """Module to handle rst operations."""
 
 import re
+from subprocess import Popen, PIPE, STDOUT
 
 from vsc.utils import fancylogger
 from vsc.utils.run import asyncloop
-from panhandler import rst_from_pan
+from instrumentation import stage, count, count_file_size
+from panhandler import rst_from_pan, get_contents_from_pans
 
 logger = fancylogger.getLogger()
 
@@ -13,25 +15,51 @@ MAILREGEX = re.compile(("([a-zA-Z0-9!#$%&'*+\/=?^_`{|}~-]+(?:\.[a-zA-Z0-9!#$%&'*
                         "\sdot\s))+[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?)"))
 PATHREGEX = re.compile(r'(\s+)((?:/[\w{}]+)+\.?\w*)(\s*)')
 EXAMPLEMAILS = ["example", "username", "system.admin"]
+BATCHREGEX = re.compile(r'==POD2RST-BATCH== (\d+) (\d+)\n')
 
 
-def generate_rst(sources):
-    """Generate rst."""
-    logger.info("Generating rst files.")
-
-    rstlist = {}
+def generate_rst(sources, batch_size=0, failures=None):
+    """
+    Generate rst.
 
-    for title, source in sources.iteritems():
-        logger.debug("Parsing %s." % source)
-        rst = None
-        if source.endswith(".pan"):
-            rst = rst_from_pan(source, title)
-        else:
-            rst = rst_from_perl(source, title)
+    If batch_size is set, perl files are converted by pod2rst-batch,
+    batch_size files per perl interpreter.
+    If failures is set, the sources pod2rst or panc-annotations failed on are added to it.
+    """
+    logger.info("Generating rst files.")
 
-        # contains more than a title
-        if rst is not None and rst.count('\n') > 6:
-            rstlist[source] = rst
+    with stage('generate_rst'):
+        rstlist = {}
+        perlrst = {}
+        if batch_size:
+            perlsources = dict((title, source) for title, source in sources.iteritems()
+                               if not source.endswith(".pan"))
+            perlrst = rst_from_perl_batch(perlsources, batch_size)
+        pancontents = get_contents_from_pans([source for source in sources.values() if source.endswith(".pan")])
+
+        for title, source in sources.iteritems():
+            logger.debug("Parsing %s." % source)
+            rst = None
+            failed = False
+            if source.endswith(".pan"):
+                if pancontents[source] is None:
+                    failed = True
+                else:
+                    with stage('pan_render'):
+                        rst = rst_from_pan(source, title, pancontents[source])
+            else:
+                if batch_size:
+                    rst = perlrst.get(source)
+                else:
+                    rst = rst_from_perl(source, title)
+                failed = rst is None
+            if failed and failures is not None:
+                failures.add(source)
+
+            # contains more than a title
+            if rst is not None and rst.count('\n') > 6:
+                rstlist[source] = rst
+        count('files', len(rstlist))
 
     return rstlist
 
@@ -43,13 +71,84 @@ def rst_from_perl(podfile, title):
     Returns True if pod2rst worked, False if it failed.
     """
     logger.info("Making rst from perl: %s." % podfile)
-    ec, output = asyncloop(["pod2rst", "--infile", podfile, "--title", title])
-    logger.debug(output)
-    if ec != 0 or output == "\n":
-        logger.warning("pod2rst failed on %s." % podfile)
-        return None
-    else:
-        return output
+    with stage('pod2rst'):
+        count('files')
+        count_file_size('bytes_read', podfile)
+        ec, output = asyncloop(["pod2rst", "--infile", podfile, "--title", title])
+        logger.debug(output)
+        if ec != 0 or output == "\n":
+            logger.warning("pod2rst failed on %s." % podfile)
+            count('failures')
+            return None
+    return output
+
+
+def rst_from_perl_batch(sources, batch_size):
+    """
+    Take perl files and convert them to reStructuredText with pod2rst-batch.
+
+    A single pod2rst-batch process converts up to batch_size files, which avoids
+    paying the perl interpreter startup for every file.
+    Returns a dict with the rst per source, None if pod2rst failed on that source.
+    """
+    items = sorted(sources.items(), key=lambda item: item[1])
+    results = {}
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        logger.info("Making rst from %s perl files with pod2rst-batch." % len(batch))
+        requests = "".join("%s\t%s\n" % (source, title) for title, source in batch)
+        with stage('pod2rst'):
+            count('files', len(batch))
+            for title, source in batch:
+                count_file_size('bytes_read', source)
+            ec, output = run_pod2rst_batch(requests)
+            if ec != 0:
+                logger.warning("pod2rst-batch exited with %s." % ec)
+            outputs = parse_batch_output(output)
+            for index, (title, source) in enumerate(batch):
+                rst = None
+                if index < len(outputs):
+                    rst = outputs[index]
+                if rst is None:
+                    logger.warning("pod2rst failed on %s." % source)
+                    count('failures')
+                results[source] = rst
+
+    return results
+
+
+def run_pod2rst_batch(requests):
+    """
+    Run pod2rst-batch on requests, return the exit code and the output.
+
+    The requests are written while the output is read, so large batches
+    do not block on full pipes.
+    """
+    try:
+        process = Popen(["pod2rst-batch"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    except OSError as err:
+        logger.warning("Could not start pod2rst-batch: %s." % err)
+        return 127, ""
+    output, dummy = process.communicate(requests)
+    return process.returncode, output
+
+
+def parse_batch_output(output):
+    """Split pod2rst-batch output in a list of rst, None for failed conversions."""
+    outputs = []
+    position = 0
+    while True:
+        header = BATCHREGEX.search(output, position)
+        if header is None:
+            break
+        start = header.end()
+        position = start + int(header.group(2))
+        rst = output[start:position]
+        if header.group(1) != '0' or rst in ("", "\n"):
+            rst = None
+        outputs.append(rst)
+
+    return outputs
 
 
 def cleanup_content(rst, cleanup_options):
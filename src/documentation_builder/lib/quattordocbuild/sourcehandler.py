@@ -8,17 +8,29 @@ files, where when there is a duplicate between '.pod' and
 """
 
 import os
+import json
+import tempfile
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 from vsc.utils import fancylogger
 from vsc.utils.run import asyncloop
+from instrumentation import stage, count
 
 logger = fancylogger.getLogger()
+SHEBANG_SIZE = 128
 
 
 def maven_clean_compile(location):
     """Execute mvn clean and mvn compile in the given modules_location."""
     logger.info("Doing maven clean compile in %s." % location)
-    ec, output = asyncloop(["mvn", "clean", "compile"], startpath=location)
+    with stage('maven'):
+        ec, output = asyncloop(["mvn", "clean", "compile"], startpath=location)
+        if ec != 0:
+            count('failures')
     logger.debug(output)
     return ec
 
@@ -43,49 +55,71 @@ def is_wanted_dir(path, files):
     return True
 
 
-def is_wanted_file(path, filename):
+def is_wanted_file(path, filename, index=None):
     """
     Check if the file matches one of the criteria.
 
      - a perl file based on extension
      - a pan file based on extension (.pan)
      - a perl file based on shebang
+
+    If an index is given, shebangs of unchanged files are taken from it.
     """
-    if True in [filename.endswith(ext) for ext in [".pod", ".pm", ".pl"]]:
+    if filename.endswith((".pod", ".pm", ".pl", ".pan")):
         return True
-    if filename.endswith(".pan"):
-        return True
-    if len(filename.split(".")) < 2:
-        with open(os.path.join(path, filename), 'r') as pfile:
-            if 'perl' in pfile.readline():
-                return True
+    if "." not in filename:
+        fullpath = os.path.join(path, filename)
+        if index is None:
+            return has_perl_shebang(fullpath)
+        stat = os.stat(fullpath)
+        cached = index['shebangs'].get(fullpath)
+        if cached is None or cached[:2] != [stat.st_mtime, stat.st_size]:
+            cached = [stat.st_mtime, stat.st_size, has_perl_shebang(fullpath)]
+        index['new_shebangs'][fullpath] = cached
+        return cached[2]
     return False
 
 
-def handle_duplicates(file, path, fulllist):
-    """Handle duplicates, pod takes preference over pm."""
+def has_perl_shebang(filename):
+    """Check if the first line of a file mentions perl, only reading a small part of the file."""
+    with open(filename, 'r') as pfile:
+        return 'perl' in pfile.readline(SHEBANG_SIZE)
+
+
+def handle_duplicates(file, path, fulllist, positions=None):
+    """
+    Handle duplicates, pod takes preference over pm.
+
+    positions maps every path in fulllist to its index, which makes the duplicate
+    lookups constant time. It is kept up to date, pass the same dict for every call.
+    """
+    if positions is None:
+        positions = {}
+        for index, item in enumerate(fulllist):
+            positions.setdefault(item, index)
+
     if "doc/pod" in path:
         duplicate = path.replace('doc/pod', 'lib/perl')
         if file.endswith('.pod'):
             duplicate = duplicate.replace(".pod", ".pm")
-            if duplicate in fulllist:
-                fulllist[fulllist.index(duplicate)] = path
+            if duplicate in positions:
+                index = positions.pop(duplicate)
+                fulllist[index] = path
+                positions[path] = index
                 return fulllist
 
     if "lib/perl" in path:
         duplicate = path.replace('lib/perl', 'doc/pod')
         if file.endswith('.pm'):
             duplicate = duplicate.replace(".pm", ".pod")
-            if duplicate not in fulllist:
-                fulllist.append(path)
-                return fulllist
-            else:
+            if duplicate in positions:
                 return fulllist
+    positions.setdefault(path, len(fulllist))
     fulllist.append(path)
     return fulllist
 
 
-def list_source_files(location):
+def list_source_files(location, index_file=None):
     """
     Return a list of source_files in a location.
 
@@ -93,21 +127,97 @@ def list_source_files(location):
      - Unwanted locations
      - Unwanted files
      - Duplicates, pod takes precedence over pm.
+
+    If index_file is set, directory listings and shebangs of unchanged
+    directories and files are reused from the previous run.
     """
     logger.info("Looking for source files.")
-    finallist = []
-    for path, _, files in os.walk(location):
-        if not is_wanted_dir(path, files):
-            continue
-
-        for file in files:
-            if is_wanted_file(path, file):
-                fullpath = os.path.join(path, file)
-                finallist = handle_duplicates(file, fullpath, finallist)
+    with stage('list_source_files'):
+        index = None
+        if index_file:
+            index = load_index(index_file)
+        finallist = []
+        positions = {}
+        for path, files in walk_source_dirs(location, index):
+            if not is_wanted_dir(path, files):
+                continue
+
+            for file in files:
+                if is_wanted_file(path, file, index):
+                    fullpath = os.path.join(path, file)
+                    finallist = handle_duplicates(file, fullpath, finallist, positions)
+        if index_file:
+            save_index(index_file, index)
+        count('files', len(finallist))
     return finallist
 
 
-def get_source_files(location, compile):
+def walk_source_dirs(location, index=None):
+    """
+    Walk a tree top-down like os.walk, yielding the path and files of every directory.
+
+    Hidden directories (e.g. .git) are pruned, the directory entry types from
+    scandir avoid a stat call per entry.
+    """
+    stack = [location]
+    while stack:
+        path = stack.pop()
+        try:
+            files, dirs = scan_dir(path, index)
+        except OSError as err:
+            logger.debug("Could not scan %s: %s" % (path, err))
+            continue
+        yield path, files
+        stack.extend(os.path.join(path, directory) for directory in reversed(dirs) if not directory.startswith('.'))
+
+
+def scan_dir(path, index=None):
+    """Return the files and subdirectories of a directory, from the index if the directory did not change."""
+    if index is not None:
+        mtime = os.stat(path).st_mtime
+        cached = index['dirs'].get(path)
+        if cached is not None and cached[0] == mtime:
+            index['new_dirs'][path] = cached
+            return cached[1], cached[2]
+
+    files = []
+    dirs = []
+    for entry in scandir(path):
+        if entry.is_dir():
+            # like os.walk, symlinks to directories are not followed
+            if not entry.is_symlink():
+                dirs.append(entry.name)
+        else:
+            files.append(entry.name)
+
+    if index is not None:
+        index['new_dirs'][path] = [mtime, files, dirs]
+    return files, dirs
+
+
+def load_index(index_file):
+    """Load a source file index, start a new one if it does not exist or is unusable."""
+    index = {'dirs': {}, 'shebangs': {}}
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, 'r') as fih:
+                index.update(json.load(fih))
+        except (IOError, ValueError) as err:
+            logger.warning("Could not read source index %s: %s." % (index_file, err))
+    index['new_dirs'] = {}
+    index['new_shebangs'] = {}
+    return index
+
+
+def save_index(index_file, index):
+    """Save the directories and files seen in this run as the new source file index."""
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fih:
+        json.dump({'dirs': index['new_dirs'], 'shebangs': index['new_shebangs']}, fih)
+    os.rename(tmpfile, index_file)
+
+
+def get_source_files(location, compile, index_file=None):
     """Run maven compile and get all source files."""
     if compile:
         ec = maven_clean_compile(location)
@@ -115,6 +225,6 @@ def get_source_files(location, compile):
             logger.error("Something went wrong running maven in %s." % location)
             return None
 
-    sources = list_source_files(location)
+    sources = list_source_files(location, index_file)
     logger.info("Found %s source files." % len(sources))
     return sources
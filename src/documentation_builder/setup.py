@@ -17,12 +17,13 @@ if __name__ == '__main__':
         author_email = 'wouter.depypere@ugent.be',
         packages = find_packages('lib'),
         package_dir={'':'lib'},
-        scripts=['bin/quattor-documentation-builder', 'bin/build-quattor-documentation.sh'],
+        scripts=['bin/quattor-documentation-builder', 'bin/build-quattor-documentation.sh', 'bin/pod2rst-batch'],
         install_requires = [
             'vsc-utils',
             'vsc-base',
             'jinja2',
             'lxml',
+            'scandir',
         ],
         test_suite = "test",
         tests_require = ["prospector"],
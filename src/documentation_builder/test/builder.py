@@ -33,11 +33,41 @@ class BuilderTest(TestCase):
         self.assertTrue(builder.check_input(self.tmpdir, self.tmpdir))
         os.makedirs(os.path.join(self.tmpdir, "test"))
         self.assertTrue(builder.check_input(self.tmpdir, os.path.join(self.tmpdir, "test")))
+        # A non-empty output location is only accepted when updating the site
+        self.assertFalse(builder.check_input(self.tmpdir, self.tmpdir))
+        self.assertTrue(builder.check_input(self.tmpdir, self.tmpdir, update=True))
 
     def test_check_commands(self):
         """Test check_commands function."""
         self.assertTrue(builder.check_commands(True))
 
+    def test_make_chunks(self):
+        """Test make_chunks function."""
+        self.assertEquals(builder.make_chunks([], 2), [])
+        collected = [('small', {'t1': 's1'}),
+                     ('big', {'t1': 'b1', 't2': 'b2', 't3': 'b3'})]
+        expected = [('big', {'t1': 'b1', 't2': 'b2'}),
+                    ('big', {'t3': 'b3'}),
+                    ('small', {'t1': 's1'})]
+        self.assertEquals(builder.make_chunks(collected, 2), expected)
+
+        # Pan and perl files are chunked separately, each with their own size
+        collected = [('repo', {'t1': 'a.pan', 't2': 'b.pan', 't3': 'c.pan', 't4': 'a.pm', 't5': 'b.pod'})]
+        expected = [('repo', {'t1': 'a.pan', 't2': 'b.pan', 't3': 'c.pan'}),
+                    ('repo', {'t4': 'a.pm'}),
+                    ('repo', {'t5': 'b.pod'})]
+        self.assertEquals(builder.make_chunks(collected, 2, 1000, 1), expected)
+        expected = [('repo', {'t1': 'a.pan', 't2': 'b.pan'}),
+                    ('repo', {'t3': 'c.pan'}),
+                    ('repo', {'t4': 'a.pm', 't5': 'b.pod'})]
+        self.assertEquals(builder.make_chunks(collected, 2), expected)
+
+    def test_run_task(self):
+        """Test run_task function."""
+        result, stats = builder.run_task((builder.rreplace, 'a-b-c', '-', '+'))
+        self.assertEquals(result, 'a-b+c')
+        self.assertEquals(stats, {})
+
     def test_build_site_structure(self):
         """Test build_site_structure function."""
         repomap = {
@@ -66,6 +96,24 @@ class BuilderTest(TestCase):
                                             'profile_functions.rst': u'\n### Functions\n'}}
         self.assertEquals(builder.build_site_structure(testdata, repomap), expected_response)
 
+    def test_store_result(self):
+        """Test store_result function."""
+        repomap = {"CCM": {"sitesection": "CCM", "targets": ["EDG/WP4/CCM/"]}}
+        source = '/tmp/qdoc/src/CCM/target/doc/pod/EDG/WP4/CCM/Fetch.pod'
+        builder.RESULTS.clear()
+
+        builder.store_result("CCM", {source: "Hello"}, repomap)
+        self.assertEquals(builder.RESULTS, {"CCM": {source: "Hello"}})
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+        # In stream mode the page is written and only the source name is kept
+        builder.RESULTS.clear()
+        builder.store_result("CCM", {source: "Hello"}, repomap, self.tmpdir)
+        self.assertEquals(builder.RESULTS, {"CCM": {source: None}})
+        with open(os.path.join(self.tmpdir, "docs", "CCM", "Fetch.rst")) as fih:
+            self.assertEquals(fih.read(), "Hello")
+        builder.RESULTS.clear()
+
     def test_make_interlinks(self):
         """Test make_interlinks function."""
         # Replace one reference
@@ -112,6 +160,24 @@ to [NCM::Component::FreeIPA::Client](https://metacpan.org/pod/NCM::Component::Fr
                      'comps': {'icinga.rst': 'ref to `icinga` and `ncm-icinga`.'}}
         self.assertEquals(builder.make_interlinks(test_data), test_data)
 
+        # Replace adjacent references
+        test_data = {'comps-gr': {'fmnt.rst': ''},
+                     'comps': {'icinga.rst': 'refr `fmnt` `fmnt`.'}}
+        expected = {'comps-gr': {'fmnt.rst': ''},
+                    'comps': {'icinga.rst': 'refr [fmnt](../comps-gr/fmnt.rst) [fmnt](../comps-gr/fmnt.rst).'}}
+        self.assertEquals(builder.make_interlinks(test_data), expected)
+
+    def test_interlink_site(self):
+        """Test interlink_site function."""
+        pages = {'components-grid': {'fmonagent.rst': 'Hello'},
+                 'components': {'icinga.rst': 'I refer to `ncm-fmonagent`.'}}
+        builder.write_site(pages, self.tmpdir, "docs")
+        builder.interlink_site(dict((subdir, dict.fromkeys(pages[subdir])) for subdir in pages), self.tmpdir, "docs")
+        with open(os.path.join(self.tmpdir, "docs", "components", "icinga.rst")) as fih:
+            self.assertEquals(fih.read(), 'I refer to [fmonagent](../components-grid/fmonagent.rst).')
+        with open(os.path.join(self.tmpdir, "docs", "components-grid", "fmonagent.rst")) as fih:
+            self.assertEquals(fih.read(), 'Hello')
+
     def test_write_site(self):
         """Test write_site function."""
         input = {'CCM': {'fetch::download.rst': '# NAME\n\nEDG::WP4::CC'},
@@ -126,6 +192,56 @@ to [NCM::Component::FreeIPA::Client](https://metacpan.org/pod/NCM::Component::Fr
         self.assertTrue(os.path.exists(os.path.join(sitedir, 'CCM')))
         self.assertTrue(os.path.exists(os.path.join(sitedir, 'CCM/fetch::download.rst')))
 
+    def test_swap_site(self):
+        """Test swap_site function."""
+        builder.write_site({'components': {'same.rst': 'same', 'changed.rst': 'old', 'stale.rst': 'stale'}},
+                           self.tmpdir, "docs")
+        sitedir = os.path.join(self.tmpdir, "docs", "components")
+        for page in os.listdir(sitedir):
+            os.utime(os.path.join(sitedir, page), (1000, 1000))
+
+        staging = mkdtemp(dir=self.tmpdir)
+        builder.write_site({'components': {'same.rst': 'same', 'changed.rst': 'new', 'new.rst': 'new'}},
+                           staging, "docs")
+        builder.swap_site(staging, self.tmpdir, "docs")
+        self.assertEquals(sorted(os.listdir(sitedir)), ['changed.rst', 'new.rst', 'same.rst'])
+        self.assertEquals(os.path.getmtime(os.path.join(sitedir, 'same.rst')), 1000)
+        self.assertNotEqual(os.path.getmtime(os.path.join(sitedir, 'changed.rst')), 1000)
+        with open(os.path.join(sitedir, 'changed.rst')) as fih:
+            self.assertEquals(fih.read(), 'new')
+        # The old site is left in staging
+        self.assertEquals(os.listdir(staging), ['docs.old'])
+
+        # If the new site can not be moved in place, the old one is put back
+        staging = mkdtemp(dir=self.tmpdir)
+        builder.write_site({'components': {'new.rst': 'newer'}}, staging, "docs")
+        rename = os.rename
+
+        def failing_rename(src, dst):
+            """Fail to move the new site."""
+            if src == os.path.join(staging, "docs"):
+                raise OSError("rename failed")
+            rename(src, dst)
+
+        os.rename = failing_rename
+        try:
+            self.assertRaises(OSError, builder.swap_site, staging, self.tmpdir, "docs")
+        finally:
+            os.rename = rename
+        self.assertEquals(sorted(os.listdir(sitedir)), ['changed.rst', 'new.rst', 'same.rst'])
+
+    def test_restore_site(self):
+        """Test restore_site function."""
+        builder.write_site({'components': {'page.rst': 'page'}}, self.tmpdir, "docs")
+        self.assertFalse(builder.restore_site(self.tmpdir, "docs"))
+
+        # An update killed between the renames left the old site in its staging directory
+        staging = mkdtemp(prefix=".staging-", dir=self.tmpdir)
+        os.rename(os.path.join(self.tmpdir, "docs"), os.path.join(staging, "docs.old"))
+        self.assertTrue(builder.restore_site(self.tmpdir, "docs"))
+        self.assertEquals(os.listdir(os.path.join(self.tmpdir, "docs", "components")), ['page.rst'])
+        self.assertFalse(builder.restore_site(self.tmpdir, "docs"))
+
     def suite(self):
         """Return all the testcases in this module."""
         return TestLoader().loadTestsFromTestCase(BuilderTest)
@@ -0,0 +1,122 @@
+"""Test class for cachehandler."""
+
+import os
+import sys
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import cachehandler
+from quattordocbuild import panhandler
+
+
+class CachehandlerTest(TestCase):
+    """Test class for cachehandler."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.source = os.path.join(self.tmpdir, "test.pod")
+        with open(self.source, 'w') as fih:
+            fih.write("=head1 NAME\n\ntest\n")
+        self.opts = {'remove_emails': True, 'codify_paths': False}
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+        cachehandler.RENDERERS.clear()
+
+    def test_get_cache_key(self):
+        """Test get_cache_key function."""
+        key = cachehandler.get_cache_key(self.source, "title", self.opts)
+        self.assertEquals(key, cachehandler.get_cache_key(self.source, "title", self.opts))
+
+        # Title and cleanup options are part of the key
+        self.assertNotEqual(key, cachehandler.get_cache_key(self.source, "title2", self.opts))
+        self.assertNotEqual(key, cachehandler.get_cache_key(self.source, "title",
+                                                            {'remove_emails': True, 'codify_paths': True}))
+
+        # So is the content
+        with open(self.source, 'a') as fih:
+            fih.write("more\n")
+        self.assertNotEqual(key, cachehandler.get_cache_key(self.source, "title", self.opts))
+
+        # And the renderer
+        key = cachehandler.get_cache_key(self.source, "title", self.opts)
+        self.assertNotEqual(key, cachehandler.get_cache_key(self.source, "title", self.opts, "pod2rst"))
+
+    def test_get_renderer(self):
+        """Test get_renderer function."""
+        pod2rst = os.path.join(self.tmpdir, "pod2rst")
+        with open(pod2rst, 'w') as fih:
+            fih.write("#!/bin/sh\n")
+        path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, path)
+        try:
+            renderer = cachehandler.get_renderer(self.source)
+            self.assertTrue(renderer.startswith(os.path.realpath(pod2rst)))
+            self.assertNotEqual(renderer, cachehandler.get_renderer(self.source, 10))
+            self.assertNotEqual(renderer, cachehandler.get_renderer("test.pan"))
+
+            # An upgraded pod2rst is another renderer
+            with open(pod2rst, 'a') as fih:
+                fih.write("exit 0\n")
+            cachehandler.RENDERERS.clear()
+            self.assertNotEqual(renderer, cachehandler.get_renderer(self.source))
+        finally:
+            os.environ['PATH'] = path
+
+        # The pan backend is part of the renderer
+        renderer = cachehandler.get_renderer("test.pan")
+        self.assertTrue(panhandler.set_pan_backend("python"))
+        try:
+            self.assertNotEqual(renderer, cachehandler.get_renderer("test.pan"))
+        finally:
+            panhandler.set_pan_backend("panc")
+
+    def test_read_write_cache(self):
+        """Test read_cache and write_cache functions."""
+        self.assertEquals(cachehandler.read_cache(self.cachedir, "abcdef"), (False, None))
+
+        cachehandler.write_cache(self.cachedir, "abcdef", "test\n")
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, "ab", "abcdef.json")))
+        self.assertEquals(cachehandler.read_cache(self.cachedir, "abcdef"), (True, u"test\n"))
+
+        # Sources without usable rst are cached as well
+        cachehandler.write_cache(self.cachedir, "123456", None)
+        self.assertEquals(cachehandler.read_cache(self.cachedir, "123456"), (True, None))
+
+    def test_split_cached(self):
+        """Test split_cached and update_cache functions."""
+        sources = {'title': self.source}
+        cached, dirty, keys = cachehandler.split_cached(sources, self.opts, self.cachedir)
+        self.assertEquals(cached, {})
+        self.assertEquals(dirty, sources)
+        self.assertEquals(keys.keys(), [self.source])
+
+        cachehandler.update_cache(keys, {self.source: "rst"}, self.cachedir)
+        cached, dirty, keys = cachehandler.split_cached(sources, self.opts, self.cachedir)
+        self.assertEquals(cached, {self.source: u"rst"})
+        self.assertEquals(dirty, {})
+        self.assertEquals(keys, {})
+
+        # A changed source is dirty again
+        with open(self.source, 'a') as fih:
+            fih.write("more\n")
+        cached, dirty, keys = cachehandler.split_cached(sources, self.opts, self.cachedir)
+        self.assertEquals(cached, {})
+        self.assertEquals(dirty, sources)
+
+        # Failed conversions are not cached
+        cachehandler.update_cache(keys, {}, self.cachedir, set([self.source]))
+        cached, dirty, keys = cachehandler.split_cached(sources, self.opts, self.cachedir)
+        self.assertEquals(dirty, sources)
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(CachehandlerTest)
+
+if __name__ == '__main__':
+    main()
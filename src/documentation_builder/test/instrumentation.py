@@ -0,0 +1,106 @@
+"""Test class for instrumentation."""
+
+import os
+import sys
+import json
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import instrumentation
+
+
+class InstrumentationTest(TestCase):
+    """Test class for instrumentation."""
+
+    def setUp(self):
+        """Set up temp dir and clean statistics for tests."""
+        self.tmpdir = mkdtemp()
+        instrumentation.reset()
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+        instrumentation.reset()
+
+    def test_stage(self):
+        """Test stage and count functions."""
+        with instrumentation.stage('build'):
+            with instrumentation.stage('generate_docs', 'repo'):
+                instrumentation.count('files', 2)
+                with instrumentation.stage('panc'):
+                    instrumentation.count('files')
+            instrumentation.count('files')
+
+        stats = instrumentation.collect()
+        self.assertEquals(sorted(stats.keys()), [None, 'repo'])
+        self.assertEquals(sorted(stats['repo'].keys()), ['generate_docs', 'panc'])
+        self.assertEquals(stats['repo']['generate_docs']['files'], 2)
+        self.assertEquals(stats['repo']['panc']['files'], 1)
+        self.assertEquals(stats[None]['build']['files'], 1)
+        self.assertEquals(stats[None]['build']['calls'], 1)
+        self.assertTrue(stats[None]['build']['time'] >= stats['repo']['generate_docs']['time'])
+
+        # Counters outside any stage end up in 'other'
+        instrumentation.count('files')
+        self.assertEquals(instrumentation.collect()[None]['other']['files'], 1)
+
+    def test_stage_failure(self):
+        """Test that exceptions are counted as failures."""
+        def failing():
+            with instrumentation.stage('write_site'):
+                raise IOError("failed")
+        self.assertRaises(IOError, failing)
+        self.assertEquals(instrumentation.collect()[None]['write_site']['failures'], 1)
+        self.assertEquals(instrumentation.ACTIVE, [])
+
+        # Only the innermost stage counts an exception passing through nested stages
+        def nested():
+            with instrumentation.stage('build'):
+                with instrumentation.stage('generate_docs', 'repo'):
+                    with instrumentation.stage('panc'):
+                        raise OSError("failed")
+        self.assertRaises(OSError, nested)
+        stats = instrumentation.collect()
+        self.assertEquals(stats['repo']['panc']['failures'], 1)
+        self.assertFalse('failures' in stats['repo']['generate_docs'])
+        self.assertFalse('failures' in stats[None]['build'])
+
+    def test_count_file_size(self):
+        """Test count_file_size function."""
+        testfile = os.path.join(self.tmpdir, "test.pod")
+        with open(testfile, 'w') as fih:
+            fih.write("0123456789")
+        with instrumentation.stage('pod2rst'):
+            instrumentation.count_file_size('bytes_read', testfile)
+            instrumentation.count_file_size('bytes_read', os.path.join(self.tmpdir, "missing"))
+        self.assertEquals(instrumentation.collect()[None]['pod2rst']['bytes_read'], 10)
+
+    def test_merge_and_report(self):
+        """Test merge, get_report and write_report functions."""
+        worker = {'repo1': {'panc': {'calls': 1, 'time': 1.0, 'subprocess_time': 0.5, 'files': 3}}}
+        instrumentation.merge(worker)
+        instrumentation.merge({'repo2': {'panc': {'calls': 2, 'time': 2.0, 'subprocess_time': 1.5, 'files': 1}}})
+        instrumentation.merge(worker)
+        with instrumentation.stage('write_site'):
+            instrumentation.count('files', 4)
+
+        report = instrumentation.get_report()
+        self.assertEquals(report['repositories']['repo1']['panc']['files'], 6)
+        self.assertEquals(report['stages']['panc'], {'calls': 4, 'time': 4.0, 'subprocess_time': 2.5, 'files': 7})
+        self.assertEquals(report['site']['write_site']['files'], 4)
+
+        reportfile = os.path.join(self.tmpdir, "report.json")
+        instrumentation.write_report(reportfile)
+        with open(reportfile) as fih:
+            written = json.load(fih)
+        self.assertEquals(written['stages']['panc']['files'], 7)
+        self.assertEquals(os.listdir(self.tmpdir), ["report.json"])
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(InstrumentationTest)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Tests for panextractor."""
+
+import sys
+import os
+from unittest import TestCase, main, TestLoader
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import panextractor as panx
+from quattordocbuild import panhandler as panh
+
+SCHEMA = """unique template quattor/test/schema;
+
+include 'pan/types';
+
+# a comment with a type = { in it
+@documentation{
+    desc = a test
+        type over two lines
+    arg = not a function argument
+}
+type test_type = extensible {
+    include structure_component
+    @{plain field}
+    'plain' : string
+    "quoted" ? long(1..) = 0x10 with is_port(SELF)
+    @documentation{desc = list of strings}
+    'list' ? string[] = list('a', "b")
+    'dict' : long(0..10){}
+    'nested' : {
+        @{nested field}
+        'inner' : boolean = true
+    } = dict()
+    'mode' : long = 0644
+    'text' : string = <<EOF;
+multi line } default
+EOF
+} = dict() with valid_test(SELF);
+
+type simple_string = string(1..255) with match(SELF, '^\\w+$');
+
+variable SOMETHING = {
+    type = 'not a type';
+};
+
+@{Return the answer}
+function the_answer = {
+    42;
+};
+
+function undocumented = 1;
+"""
+
+
+class PanExtractorTest(TestCase):
+    """Test class for panextractor."""
+
+    def test_conformance(self):
+        """Test that the extracted content is the same as the content from panc-annotations."""
+        expected = panh.get_content_from_annotations("test/testdata/pan_annotated_output.xml")
+        self.assertEqual(panx.get_content_from_panfile("test/testdata/pan_annotated_schema.pan"), expected)
+
+        expected = panh.get_content_from_annotations("test/testdata/pan_empty_annotated_output.xml")
+        self.assertEqual(panx.get_content_from_panfile("test/testdata/pan_empty_input.pan"), expected)
+
+    def test_get_content_from_source(self):
+        """Test get_content_from_source function."""
+        content = panx.get_content_from_source(SCHEMA)
+        self.assertEqual([ptype['name'] for ptype in content['types']], ['test_type', 'simple_string'])
+
+        ptype = content['types'][0]
+        self.assertEqual(ptype['desc'], 'a test type over two lines')
+        fields = dict((field['name'], field) for field in ptype['fields'])
+        self.assertEqual([field['name'] for field in ptype['fields']],
+                         ['plain', 'quoted', 'list', 'dict', 'nested', 'inner', 'mode', 'text'])
+        self.assertEqual(fields['plain'], {'name': 'plain', 'desc': 'plain field', 'required': 'true',
+                                           'type': 'string'})
+        self.assertEqual(fields['quoted'], {'name': 'quoted', 'required': 'false', 'type': 'long',
+                                            'range': '1..', 'default': '16'})
+        self.assertEqual(fields['list'], {'name': 'list', 'desc': 'list of strings', 'required': 'false',
+                                          'type': 'string', 'default': 'list(\'a\', "b")'})
+        self.assertEqual(fields['dict']['range'], '0..10')
+        self.assertEqual(fields['nested']['type'], None)
+        self.assertEqual(fields['nested']['default'], 'dict()')
+        self.assertEqual(fields['inner'], {'name': 'inner', 'desc': 'nested field', 'required': 'true',
+                                           'type': 'boolean', 'default': 'true'})
+        self.assertEqual(fields['mode']['default'], '420')
+        self.assertEqual(fields['text']['default'], 'multi line } default\n')
+
+        self.assertEqual(content['types'][1], {'name': 'simple_string', 'fields': []})
+        self.assertEqual(content['functions'], [{'name': 'the_answer', 'desc': 'Return the answer', 'args': []},
+                                                {'name': 'undocumented', 'args': []}])
+
+        # Only functions, still both keys
+        self.assertEqual(panx.get_content_from_source("function f = 1;\n"),
+                         {'types': [], 'functions': [{'name': 'f', 'args': []}]})
+        self.assertEqual(panx.get_content_from_source("object template test;\n'/a' = 1;\n"), {})
+
+    def test_parse_key_values(self):
+        """Test parse_key_values function."""
+        self.assertEqual(panx.parse_key_values("desc = a\n  b\narg=c"), [('desc', 'a\n  b'), ('arg', 'c')])
+        self.assertEqual(panx.parse_key_values("just text = no"), None)
+        self.assertEqual(panx.parse_key_values(""), None)
+
+    def test_number_text(self):
+        """Test number_text function."""
+        self.assertEqual(panx.number_text("0"), "0")
+        self.assertEqual(panx.number_text("12L"), "12")
+        self.assertEqual(panx.number_text("0755"), "493")
+        self.assertEqual(panx.number_text("0xFF"), "255")
+        self.assertEqual(panx.number_text("1.5e-3"), "1.5e-3")
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(PanExtractorTest)
+
+if __name__ == '__main__':
+    main()
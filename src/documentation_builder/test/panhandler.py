@@ -162,6 +162,17 @@ class PanHandlerTest(TestCase):
         - Optional\n        - Type: string\n'
         self.assertEquals(output, expectedoutput)
 
+    def test_render_template_cached(self):
+        """Test the template is compiled only once."""
+        content = {'functions': [{'args': ['first number to add'], 'name': 'add'}]}
+        output = panh.render_template(content, "component-test", "test::schema")
+        template = panh.get_jinja_env().get_template('pan.j2')
+        self.assertEqual(panh.render_template(content, "component-test", "test::schema"), output)
+        self.assertIs(panh.get_jinja_env(), panh.JINJA_ENV)
+        self.assertIs(panh.get_jinja_env().get_template('pan.j2'), template)
+        # Nothing is written to disk, so pool workers can not read half written bytecode
+        self.assertIsNone(panh.JINJA_ENV.bytecode_cache)
+
     def test_get_content_from_pan(self):
         """Test get_content_from_pan function."""
         # Test with empty pan input file.
@@ -194,6 +205,74 @@ class PanHandlerTest(TestCase):
         # Test with valid input.
         self.assertEqual(panh.get_content_from_pan("test/testdata/pan_annotated_schema.pan"), expectedresult)
 
+    def test_get_content_from_annotations(self):
+        """Test get_content_from_annotations function."""
+        self.assertEqual(panh.get_content_from_annotations("test/testdata/pan_empty_annotated_output.xml"), {})
+        content = panh.get_content_from_annotations("test/testdata/pan_annotated_output.xml")
+        self.assertEqual(sorted(content.keys()), ['functions', 'types'])
+        self.assertEqual([ptype['name'] for ptype in content['types']], ['testtype'])
+        self.assertEqual([function['name'] for function in content['functions']], ['add'])
+
+    def test_iter_annotations(self):
+        """Test iter_annotations function."""
+        xmlfile = "test/testdata/pan_annotated_output.xml"
+        root = panh.validate_annotations(xmlfile)
+        types, functions = panh.get_types_and_functions(root)
+        self.assertEqual(list(panh.iter_annotations(xmlfile)),
+                         [('types', panh.parse_type(types[0])), ('functions', panh.parse_function(functions[0]))])
+        self.assertEqual(list(panh.iter_annotations("test/testdata/pan_empty_annotated_output.xml")), [])
+
+        # Nested records: the outer field gets the first basetype and default inside it, like parse_type
+        xmlfile = os.path.join(self.tmpdir, "nested.xml")
+        with open(xmlfile, 'w') as fih:
+            fih.write('<?xml version="1.0" encoding="UTF-8"?>'
+                      '<template xmlns="http://quattor.org/pan/annotations" name="nested">'
+                      '<documentation><desc>template</desc></documentation>'
+                      '<type name="outer"><desc>plain</desc><documentation><desc>preferred</desc></documentation>'
+                      '<basetype><field name="record" required="true"><basetype extensible="false">'
+                      '<field name="inner" required="false"><desc>inner field</desc>'
+                      '<basetype name="long" range="0..1"/><default text="1"/></field>'
+                      '</basetype></field></basetype></type></template>')
+        root = panh.validate_annotations(xmlfile)
+        types, functions = panh.get_types_and_functions(root)
+        self.assertEqual(list(panh.iter_annotations(xmlfile)), [('types', panh.parse_type(types[0]))])
+        self.assertEqual(panh.get_content_from_annotations(xmlfile),
+                         {'types': [panh.parse_type(types[0])], 'functions': []})
+
+    def test_get_contents_from_pans(self):
+        """Test get_contents_from_pans function."""
+        self.assertEqual(panh.get_contents_from_pans([]), {})
+
+        testfile1 = "test/testdata/pan_annotated_schema.pan"
+        testfile2 = "test/testdata/pan_empty_input.pan"
+        contents = panh.get_contents_from_pans([testfile1, testfile2])
+        self.assertEqual(sorted(contents.keys()), [testfile1, testfile2])
+        self.assertEqual(contents[testfile1], panh.get_content_from_pan(testfile1))
+        self.assertEqual(contents[testfile2], {})
+
+    def test_set_pan_backend(self):
+        """Test get_contents_from_pans with the python backend."""
+        self.assertFalse(panh.set_pan_backend("java"))
+        self.assertEqual(panh.PAN_BACKEND, "panc")
+        self.assertTrue(panh.set_pan_backend("python"))
+        try:
+            testfile1 = "test/testdata/pan_annotated_schema.pan"
+            testfile2 = "test/testdata/pan_empty_input.pan"
+            contents = panh.get_contents_from_pans([testfile1, testfile2])
+            self.assertEqual(contents[testfile1],
+                             panh.get_content_from_annotations("test/testdata/pan_annotated_output.xml"))
+            self.assertEqual(contents[testfile2], {})
+            self.assertEqual(panh.get_content_from_pan(testfile1), contents[testfile1])
+        finally:
+            panh.set_pan_backend("panc")
+
+    def test_get_common_basedir(self):
+        """Test get_common_basedir function."""
+        self.assertEqual(panh.get_common_basedir(["/tmp/a/b/c.pan"]), "/tmp/a/b/")
+        self.assertEqual(panh.get_common_basedir(["/tmp/a/b/c.pan", "/tmp/a/bc/d.pan"]), "/tmp/a/")
+        self.assertEqual(panh.get_common_basedir(["/a.pan", "/b/c.pan"]), "/")
+        self.assertEqual(panh.get_common_basedir(["a/b.pan", "c/d.pan"]), ".")
+
     def test_rst_from_pan(self):
         """Test rst_from_pan function."""
         # Test valid input
@@ -10,6 +10,15 @@ from unittest import TestCase, main, TestLoader
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
 from quattordocbuild import rsthandler as rsth
 
+STUB_POD2RST_BATCH = """#!%s
+import sys
+for line in iter(sys.stdin.readline, ''):
+    infile, title = line.rstrip('\\n').split('\\t', 1)
+    content = "%%s\\n%%s\\n" %% (title, '=' * 200)
+    sys.stdout.write("==POD2RST-BATCH== 0 %%s\\n%%s" %% (len(content), content))
+    sys.stdout.flush()
+"""
+
 
 class RstHandlerTest(TestCase):
     """Test class for rsthandler."""
@@ -39,6 +48,43 @@ class RstHandlerTest(TestCase):
         file.close()
         self.assertTrue(filecmp.cmp(testoutput, expectedoutput))
 
+    def test_rst_from_perl_batch(self):
+        """Test rst_from_perl_batch function."""
+        testinput = "test/testdata/pod_test_input.pod"
+        expectedoutput = "test/testdata/rst_from_pod.rst"
+
+        output = rsth.rst_from_perl_batch({'testtitle': testinput, 'allo': 'nonexistent_file'}, 1)
+        self.assertEquals(sorted(output.keys()), ['nonexistent_file', testinput])
+        self.assertIsNone(output['nonexistent_file'])
+        with open(expectedoutput) as fih:
+            self.assertEquals(output[testinput], fih.read())
+
+    def test_rst_from_perl_batch_large(self):
+        """Test rst_from_perl_batch with a batch larger than the pipe buffers."""
+        stub = os.path.join(self.tmpdir, "pod2rst-batch")
+        with open(stub, 'w') as fih:
+            fih.write(STUB_POD2RST_BATCH % sys.executable)
+        os.chmod(stub, 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, path)
+        try:
+            sources = dict(("title%s" % index, "/%s/file%s.pod" % ("x" * 100, index)) for index in range(2000))
+            output = rsth.rst_from_perl_batch(sources, 2000)
+        finally:
+            os.environ['PATH'] = path
+        self.assertEquals(len(output), 2000)
+        self.assertEquals(output["/%s/file1999.pod" % ("x" * 100)], "title1999\n%s\n" % ("=" * 200))
+
+    def test_parse_batch_output(self):
+        """Test parse_batch_output function."""
+        self.assertEquals(rsth.parse_batch_output(""), [])
+        output = "==POD2RST-BATCH== 0 6\nhello\n==POD2RST-BATCH== 1 0\n==POD2RST-BATCH== 0 1\n\n"
+        self.assertEquals(rsth.parse_batch_output(output), ["hello\n", None, None])
+
+        # Content looking like a header and stray warnings are handled
+        output = "some warning\n==POD2RST-BATCH== 0 23\n==POD2RST-BATCH== 0 1\n\n"
+        self.assertEquals(rsth.parse_batch_output(output), ["==POD2RST-BATCH== 0 1\n\n"])
+
     def test_generate_rst(self):
         """Test generate_rst."""
         testdir = os.path.join(self.tmpdir, "testdata/target")
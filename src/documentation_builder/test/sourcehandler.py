@@ -90,6 +90,15 @@ class SourcehandlerTest(TestCase):
         # Add a pm file when a pod file is in the list, get a list with only the pod file back
         self.assertEquals(sourcehandler.handle_duplicates('test.pm', testperlfile, [testpodfile]), [testpodfile])
 
+        # Keep the positions up to date over several calls
+        positions = {}
+        fulllist = []
+        for file, path in [('test.pm', testperlfile), ('other.pm', 'test/lib/perl/other.pm'),
+                           ('test.pod', testpodfile), ('test.pm', testperlfile.replace('test', 'test2', 1))]:
+            fulllist = sourcehandler.handle_duplicates(file, path, fulllist, positions)
+        self.assertEquals(fulllist, [testpodfile, 'test/lib/perl/other.pm', 'test2/lib/perl/test.pm'])
+        self.assertEquals(positions, dict((path, index) for index, path in enumerate(fulllist)))
+
     def test_list_source_files(self):
         """Test list_source_files function."""
         # Test a bogus dir
@@ -105,6 +114,41 @@ class SourcehandlerTest(TestCase):
 
         self.assertEquals(sourcehandler.list_source_files(fulltestdir), [os.path.join(fulltestdir, testfile)])
 
+    def test_list_source_files_index(self):
+        """Test list_source_files function with a source file index."""
+        fulltestdir = os.path.join(self.tmpdir, 'target/lib/perl')
+        hiddendir = os.path.join(self.tmpdir, '.git/target/lib/perl')
+        os.makedirs(fulltestdir)
+        os.makedirs(hiddendir)
+        for testfile, content in [(os.path.join(fulltestdir, 'test.pm'), 'test\n'),
+                                  (os.path.join(hiddendir, 'test.pm'), 'test\n'),
+                                  (os.path.join(fulltestdir, 'script'), '#!/usr/bin/perl\n'),
+                                  (os.path.join(fulltestdir, 'other'), '#!/bin/bash\n')]:
+            with open(testfile, 'w') as fih:
+                fih.write(content)
+        expected = [os.path.join(fulltestdir, 'script'), os.path.join(fulltestdir, 'test.pm')]
+
+        # Hidden directories are skipped
+        self.assertEquals(sorted(sourcehandler.list_source_files(self.tmpdir)), expected)
+
+        indexfile = os.path.join(self.tmpdir, 'index.json')
+        self.assertEquals(sorted(sourcehandler.list_source_files(self.tmpdir, indexfile)), expected)
+        self.assertTrue(os.path.exists(indexfile))
+        index = sourcehandler.load_index(indexfile)
+        self.assertTrue(fulltestdir in index['dirs'])
+        self.assertEquals(index['shebangs'][os.path.join(fulltestdir, 'script')][2], True)
+        self.assertEquals(index['shebangs'][os.path.join(fulltestdir, 'other')][2], False)
+
+        # Reusing the index gives the same result
+        self.assertEquals(sorted(sourcehandler.list_source_files(self.tmpdir, indexfile)), expected)
+
+        # New files are found
+        with open(os.path.join(fulltestdir, 'test2.pl'), 'w') as fih:
+            fih.write("test\n")
+        os.utime(fulltestdir, (0, 0))
+        self.assertEquals(sorted(sourcehandler.list_source_files(self.tmpdir, indexfile)),
+                          expected + [os.path.join(fulltestdir, 'test2.pl')])
+
     def test_get_source_files(self):
         """Test get_source_files function."""
         self.assertEquals(sourcehandler.get_source_files(self.tmpdir, False), [])
@@ -2,14 +2,15 @@
 
 import logging
 from urllib import urlopen
-from json import load
+from json import load, dump
 from datetime import datetime, timedelta
 from os.path import exists, isdir, join, abspath
-from os import chdir, makedirs, sep
+from os import makedirs
 from shutil import rmtree
 from tempfile import mkdtemp
 from sys import exit as sys_exit
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 import subprocess
 import errno
 
@@ -24,7 +25,10 @@ LIBRARY_BRANCHES = {
 }
 
 BIN_GIT = '/usr/bin/git'
-BIN_RSYNC = '/usr/bin/rsync'
+BIN_TAR = '/bin/tar'
+
+# Hidden, so it is never part of an exported tree
+SYNC_STATE_FILE = '.template-library-sync.json'
 
 
 def execute(command):
@@ -92,26 +96,95 @@ def get_current_releases():
     return results
 
 
-def sync_template_library(base_dir, releases):
+def export_tag(mirror_dir, tag, target_dir):
+    """Export the tree of a tag from a git mirror into target_dir, skipping hidden files (like .gitignore)"""
     logger = logging.getLogger('sync-template-library')
+    archive = subprocess.Popen(
+        [BIN_GIT, '--git-dir', mirror_dir, 'archive', '--format=tar', tag],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    extract = subprocess.Popen(
+        [BIN_TAR, '-x', '--exclude=.*', '-C', target_dir],
+        stdin=archive.stdout,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    # Allow git archive to receive a SIGPIPE if tar exits early
+    archive.stdout.close()
+    output, error = extract.communicate()
+    archive_error = archive.stderr.read()
+    archive.wait()
+    logger.debug('Exported %s to %s, stdout: "%s", stderr: "%s"', tag, target_dir, output.strip(), error.strip())
+    if archive.returncode > 0 or extract.returncode > 0:
+        logger.error('Exporting %s failed with errors: "%s"', tag, (archive_error + error).strip())
+        return False
+    return True
+
+
+def resolve_tag(mirror_dir, tag):
+    """Return the commit id a tag points to in a git mirror, None if the tag does not exist"""
+    logger = logging.getLogger('sync-template-library')
+    process = subprocess.Popen(
+        [BIN_GIT, '--git-dir', mirror_dir, 'rev-parse', '--verify', '--quiet', '%s^{commit}' % tag],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    output, error = process.communicate()
+    if process.returncode > 0:
+        logger.debug('Tag %s not found in %s: "%s"', tag, mirror_dir, error.strip())
+        return None
+    return output.strip()
+
+
+def read_sync_state(target_dir):
+    """Return the commit id recorded by the last successful sync of target_dir, None if there is none"""
+    logger = logging.getLogger('sync-template-library')
+    try:
+        with open(join(target_dir, SYNC_STATE_FILE)) as state_file:
+            return load(state_file).get('commit')
+    except (IOError, ValueError), e:
+        logger.debug('No usable sync state in %s: %s', target_dir, e)
+    return None
+
+
+def write_sync_state(target_dir, tag, commit):
+    """Record the tag and commit id target_dir was synced to"""
+    with open(join(target_dir, SYNC_STATE_FILE), 'w') as state_file:
+        dump({'tag': tag, 'commit': commit, 'synced': datetime.now().isoformat()}, state_file)
 
-    logger.debug('Using %s as base directory', base_dir)
 
-    for library, branches in LIBRARY_BRANCHES.iteritems():
-        logger.info('Processing library %s', library)
+def update_mirror(url, mirror_dir):
+    """Create or update a bare mirror of a git repository"""
+    logger = logging.getLogger('sync-template-library')
+    if exists(mirror_dir):
+        logger.info('Updating mirror %s of %s', mirror_dir, url)
+        return execute([BIN_GIT, '--git-dir', mirror_dir, 'remote', 'update', '--prune'])
+    logger.info('Cloning %s to %s', url, mirror_dir)
+    return execute([BIN_GIT, 'clone', '--mirror', url, mirror_dir])
+
+
+def sync_library(base_dir, releases, library, branches, cache_dir, force=False):
+    """Export all releases of all branches of a single library from its mirror into base_dir"""
+    logger = logging.getLogger('sync-template-library')
+    logger.info('Processing library %s', library)
 
-        url = LIBRARY_URL_PATTERN % (library)
+    url = LIBRARY_URL_PATTERN % (library)
+    if cache_dir:
+        temp_dir = None
+        mirror_dir = join(cache_dir, 'template-library-%s.git' % library)
+    else:
         temp_dir = mkdtemp(prefix='quattor-template-library_')
-        logger.info('Cloning %s to %s', url, temp_dir)
-        execute([BIN_GIT, 'clone', url, temp_dir])
-        chdir(temp_dir)
+        mirror_dir = join(temp_dir, 'template-library-%s.git' % library)
+
+    if update_mirror(url, mirror_dir):
         logger.info('Done')
 
         for release in releases:
             logger.info('Release %s available', release)
 
             for branch in branches:
-                logger.info('  Processing branch %s', branch)
+                logger.info('  Processing branch %s of %s', branch, library)
                 tag = release
 
                 target_dir = join(base_dir, release, library)
@@ -121,16 +194,21 @@ def sync_template_library(base_dir, releases):
                     target_dir = join(target_dir, branch)
                     logger.debug('Added branch to target dir, which is now %s', target_dir)
 
+                commit = resolve_tag(mirror_dir, tag)
+                if commit is None:
+                    logger.warning('  Tag %s does not exist in library %s, skipping', tag, library)
+                    continue
+                if not force and read_sync_state(target_dir) == commit:
+                    logger.info('  Tag %s already synced to %s at %s, skipping', tag, target_dir, commit)
+                    continue
+
                 make_target_dir(target_dir)
 
-                logger.info('  Checking out tag %s', tag)
-                if execute([BIN_GIT, 'checkout', tag]):
-                    source = temp_dir + sep
-                    target = target_dir + sep
-                    logger.info('  rsyncing tag from %s to %s', source, target)
-                    execute([BIN_RSYNC, '-rtx', '--exclude=.*', source, target])
+                logger.info('  Exporting tag %s (%s) to %s', tag, commit, target_dir)
+                if export_tag(mirror_dir, commit, target_dir):
+                    write_sync_state(target_dir, tag, commit)
 
-        chdir(base_dir)
+    if temp_dir:
         try:
             rmtree(temp_dir)
             logger.debug('Removed temporary directory %s', temp_dir)
@@ -138,6 +216,34 @@ def sync_template_library(base_dir, releases):
             logger.error('Caught exception %s trying to remove temporary directory %s', temp_dir, e.strerror)
 
 
+def sync_template_library(base_dir, releases, cache_dir=None, jobs=None, force=False):
+    """
+    Synchronise all template libraries, processing up to jobs libraries concurrently.
+
+    Each library is kept as a bare mirror in cache_dir (or a temporary directory when no cache_dir is given),
+    and every release tag is exported with git archive rather than checked out and rsynced.
+    Target directories already synced to the commit of their tag are skipped, unless force is set.
+    """
+    logger = logging.getLogger('sync-template-library')
+
+    logger.debug('Using %s as base directory', base_dir)
+    if cache_dir:
+        logger.debug('Using %s as mirror cache directory', cache_dir)
+        make_target_dir(cache_dir)
+
+    if not jobs:
+        jobs = len(LIBRARY_BRANCHES)
+    pool = ThreadPool(jobs)
+    results = [
+        pool.apply_async(sync_library, (base_dir, releases, library, branches, cache_dir, force))
+        for library, branches in LIBRARY_BRANCHES.iteritems()
+    ]
+    pool.close()
+    pool.join()
+    # Re-raise any exception from the workers
+    for result in results:
+        result.get()
+
 
 if __name__ == '__main__':
     logging.basicConfig(
@@ -149,6 +255,9 @@ if __name__ == '__main__':
     parser = ArgumentParser(description='Synchronise quattor template libraries')
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
     parser.add_argument('--releases', help='Sync specific release(s), delimit multiple releases with commas')
+    parser.add_argument('--cache-dir', help='Keep git mirrors of the libraries in this directory between runs')
+    parser.add_argument('--jobs', type=int, help='Number of libraries to process concurrently (default: all)')
+    parser.add_argument('--force', action='store_true', help='Export all tags, even if they were synced before')
     parser.add_argument(
         'path',
         metavar='PATH',
@@ -166,6 +275,10 @@ if __name__ == '__main__':
     else:
         releases = get_current_releases()
 
-    sync_template_library(abspath(args.path), releases)
+    cache_dir = None
+    if args.cache_dir:
+        cache_dir = abspath(args.cache_dir)
+
+    sync_template_library(abspath(args.path), releases, cache_dir, args.jobs, args.force)
 
     sys_exit(0)